@@ -0,0 +1,265 @@
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import time
+import argparse
+import multiprocessing
+
+from hippodclient import bundle
+from hippodclient.endpoints import STRATEGIES, STRATEGY_LEAST_OUTSTANDING
+from hippodclient.hippodclient import Container, ConfigurationException
+from hippodclient.hippodclient import REQUEST_TIMEOUT, REQUEST_CONCURRENCY
+
+
+PROGRESS_INTERVAL = 0.5
+
+# set in every replay worker by the pool initializer
+_progress_queue = None
+
+
+def _replay_init(queue):
+    global _progress_queue
+    _progress_queue = queue
+
+
+def _replay_shard(task):
+    """ Upload one shard of one bundle, runs in a pool worker """
+    path, shard, shards, args = task
+    done = set()
+    if args.resume:
+        done = bundle.journal_load(path)
+    journal = bundle.Journal(path)
+    container = Container(url=args.url, timeout=args.timeout,
+                          concurrency=args.concurrency, strategy=args.strategy)
+    container._check_pre_sync()
+    stats = {"uploaded": 0, "failed": 0, "skipped": 0, "bytes": 0}
+    record_ids = list()
+
+    def documents():
+        for record_id, json_data in bundle.BundleReader(path).tests(shard, shards):
+            if record_id in done:
+                stats["skipped"] += 1
+                _progress_queue.put(("skipped", 0))
+                continue
+            record_ids.append(record_id)
+            stats["bytes"] += len(json_data)
+            yield json_data
+
+    def callback(index, ret):
+        ok, _ = ret
+        if ok:
+            journal.add(record_ids[index])
+            stats["uploaded"] += 1
+            _progress_queue.put(("uploaded", 0))
+        else:
+            stats["failed"] += 1
+            _progress_queue.put(("failed", 0))
+
+    try:
+        container.loop.run_until_complete(container._send_all(documents(), callback))
+    finally:
+        journal.close()
+    return stats
+
+
+class Progress(object):
+
+    def __init__(self, stream=sys.stderr):
+        self.stream = stream
+        self.counter = {"uploaded": 0, "failed": 0, "skipped": 0}
+        self.start = time.time()
+        self.last = 0
+
+    def update(self, kind, force=False):
+        if kind:
+            self.counter[kind] += 1
+        now = time.time()
+        if not force and now - self.last < PROGRESS_INTERVAL:
+            return
+        self.last = now
+        rate = self.counter["uploaded"] / max(now - self.start, 1e-9)
+        msg = "\r{uploaded} uploaded, {failed} failed, {skipped} skipped".format(**self.counter)
+        self.stream.write("{} ({:.1f} tests/s)".format(msg, rate))
+        self.stream.flush()
+
+
+def cmd_replay(args):
+    for path in args.bundles:
+        if not os.path.isfile(path):
+            sys.stderr.write("Bundle '{}' is not available\n".format(path))
+            return 1
+    members = dict()
+    try:
+        # check and index each bundle once, before the workers read it
+        for path in args.bundles:
+            members[path] = len(bundle.index_read(path)[1])
+    except bundle.BundleException as e:
+        sys.stderr.write("replay: {}\n".format(e))
+        return 1
+    jobs = args.jobs or multiprocessing.cpu_count()
+    # shard big bundles across cores by gzip members, many small
+    # bundles are distributed over the pool as a whole
+    shards = max(1, -(-jobs // len(args.bundles)))
+    tasks = list()
+    for path in args.bundles:
+        count = max(1, min(shards, members[path]))
+        tasks.extend((path, shard, count, args) for shard in range(count))
+
+    queue = multiprocessing.Queue()
+    progress = Progress()
+    pool = multiprocessing.Pool(jobs, initializer=_replay_init, initargs=(queue,))
+    result = pool.map_async(_replay_shard, tasks)
+    pool.close()
+    while not result.ready() or not queue.empty():
+        try:
+            kind, _ = queue.get(timeout=PROGRESS_INTERVAL)
+        except Exception:
+            kind = None
+        progress.update(kind)
+    pool.join()
+    progress.update(None, force=True)
+    sys.stderr.write("\n")
+
+    try:
+        results = result.get()
+    except (bundle.BundleException, ConfigurationException) as e:
+        sys.stderr.write("replay: {}\n".format(e))
+        return 1
+    stats = {"uploaded": 0, "failed": 0, "skipped": 0, "bytes": 0}
+    for shard_stats in results:
+        for key in stats:
+            stats[key] += shard_stats[key]
+    elapsed = max(time.time() - progress.start, 1e-9)
+    sys.stderr.write("{} tests uploaded, {} failed, {} skipped in {:.2f}s\n".format(
+                     stats["uploaded"], stats["failed"], stats["skipped"], elapsed))
+    sys.stderr.write("throughput: {:.1f} tests/s, {:.2f} MiB/s\n".format(
+                     stats["uploaded"] / elapsed, stats["bytes"] / elapsed / (1 << 20)))
+    return 0 if stats["failed"] == 0 else 2
+
+
+def cmd_bench_transport(args):
+    from hippodclient import bench
+    transports = args.transport or ["memory"]
+    results = bench.bench_transport(args.url, transports, count=args.count,
+                                    concurrency=args.concurrency, payload=args.payload)
+    bench.print_results(results)
+    return 0
+
+
+def cmd_bench_import(args):
+    from hippodclient import bench
+    modules = bench.bench_import()
+    results = list()
+    for name, (own, cumulative) in sorted(modules.items(), key=lambda i: -i[1][0]):
+        results.append({"module": name, "self ms": own * 1e3, "cumulative ms": cumulative * 1e3})
+    bench.print_results(results[:args.top])
+    total = sum(own for own, _ in modules.values())
+    sys.stdout.write("{} modules imported in {:.2f} ms\n".format(len(modules), total * 1e3))
+    return 0
+
+
+def cmd_bench_pytest(args):
+    from hippodclient import bench
+    bench.print_results(bench.bench_pytest(args.count))
+    return 0
+
+
+def cmd_bench_encode(args):
+    from hippodclient import bench
+    sizes = args.size or [10, 100, 1024]
+    bench.print_results(bench.bench_encode(sizes, args.tmpdir))
+    return 0
+
+
+def cmd_relay(args):
+    from hippodclient.relay import Relay
+    relay = Relay(args.url, path=args.socket, concurrency=args.concurrency,
+                  queue_size=args.queue_size, spool=args.spool, retries=args.retries,
+                  timeout=args.timeout, strategy=args.strategy)
+    sys.stderr.write("relay listening on {}\n".format(relay.path))
+    relay.run()
+    sys.stderr.write("relay stopped: {}\n".format(relay.stats))
+    return 0
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(prog="hippodclient",
+                                     description="Python client to interact with HippoD")
+    subparsers = parser.add_subparsers(dest="command")
+    subparsers.required = True
+
+    replay = subparsers.add_parser("replay", help="upload offline bundles")
+    replay.add_argument("bundles", nargs="+", help="bundle files written by Container.export()")
+    replay.add_argument("--url", required=True, action="append",
+                        help="HippoD server URL, repeat to balance over several servers")
+    replay.add_argument("--strategy", default=STRATEGY_LEAST_OUTSTANDING, choices=STRATEGIES,
+                        help="load balancing strategy for several servers")
+    replay.add_argument("-j", "--jobs", type=int, default=0,
+                        help="worker processes (default: number of cores)")
+    replay.add_argument("-c", "--concurrency", type=int, default=REQUEST_CONCURRENCY,
+                        help="concurrent requests per worker")
+    replay.add_argument("--timeout", type=float, default=REQUEST_TIMEOUT)
+    replay.add_argument("--no-resume", dest="resume", action="store_false",
+                        help="upload all tests, ignore the journal of earlier runs")
+    replay.set_defaults(func=cmd_replay)
+
+    relay = subparsers.add_parser("relay", help="host-local relay for transport=\"relay\"")
+    relay.add_argument("--url", required=True, action="append",
+                       help="HippoD server URL, repeat to balance over several servers")
+    relay.add_argument("--strategy", default=STRATEGY_LEAST_OUTSTANDING, choices=STRATEGIES)
+    relay.add_argument("--socket", default=None,
+                       help="Unix socket path (default: $HIPPOD_RELAY_SOCKET or runtime dir)")
+    relay.add_argument("-c", "--concurrency", type=int, default=4,
+                       help="upstream connections")
+    relay.add_argument("--queue-size", type=int, default=10000,
+                       help="tests queued before clients are rejected")
+    relay.add_argument("--spool", default=None,
+                       help="bundle for tests which could not be uploaded "
+                            "(default: $XDG_STATE_HOME/hippodclient/relay-spool.ndjson.gz)")
+    relay.add_argument("--retries", type=int, default=5,
+                       help="upload attempts per test before it is spooled")
+    relay.add_argument("--timeout", type=float, default=REQUEST_TIMEOUT)
+    relay.set_defaults(func=cmd_relay)
+
+    bench = subparsers.add_parser("bench", help="client side benchmarks")
+    benchmarks = bench.add_subparsers(dest="benchmark")
+    benchmarks.required = True
+
+    transport = benchmarks.add_parser("transport", help="compare upload transports")
+    transport.add_argument("--url", default="http://127.0.0.1/",
+                           help="HippoD server URL, unused by the memory transport")
+    transport.add_argument("-t", "--transport", action="append",
+                           choices=["aiohttp", "http2", "h2c", "memory"],
+                           help="transport to measure, repeat to compare (default: memory)")
+    transport.add_argument("-n", "--count", type=int, default=1000, help="number of uploads")
+    transport.add_argument("-c", "--concurrency", type=int, default=REQUEST_CONCURRENCY)
+    transport.add_argument("--payload", type=int, default=0,
+                           help="additional bytes of data per test")
+    transport.set_defaults(func=cmd_bench_transport)
+
+    startup = benchmarks.add_parser("import", help="import time of a short lived process")
+    startup.add_argument("--top", type=int, default=20, help="show the slowest modules")
+    startup.set_defaults(func=cmd_bench_import)
+
+    plugin = benchmarks.add_parser("pytest", help="overhead of the pytest plugin")
+    plugin.add_argument("-n", "--count", type=int, default=10000,
+                        help="number of synthetic tests")
+    plugin.set_defaults(func=cmd_bench_pytest)
+
+    encode = benchmarks.add_parser("encode", help="memory and time to encode file attachments")
+    encode.add_argument("-s", "--size", type=int, action="append",
+                        help="attachment size in MiB, repeatable (default: 10, 100, 1024)")
+    encode.add_argument("--tmpdir", default=None, help="directory for the attachment files")
+    encode.set_defaults(func=cmd_bench_encode)
+
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    return args.func(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
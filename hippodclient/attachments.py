@@ -0,0 +1,355 @@
+# -*- coding: utf-8 -*-
+
+import os
+import io
+import re
+import mmap
+import base64
+import struct
+import zlib
+import binascii
+import itertools
+
+from hippodclient.hippodclient import ArgumentException
+
+
+# text log fraction kept from the beginning, the rest from the end
+TEXT_HEAD_RATIO = 0.5
+TRIM_MARKER = "\n[... {} bytes trimmed by hippodclient ...]\n"
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+# ancillary chunks which do not influence how the image is displayed
+PNG_DROP_CHUNKS = (b"tEXt", b"zTXt", b"iTXt", b"tIME")
+
+PCAP_MAGICS = (b"\xa1\xb2\xc3\xd4", b"\xd4\xc3\xb2\xa1",
+               b"\xa1\xb2\x3c\x4d", b"\x4d\x3c\xb2\xa1")
+PCAP_GLOBAL_HEADER = 24
+PCAP_RECORD_HEADER = 16
+
+TEXT_MIME_TYPES = ("application/json", "application/xml", "application/x-sh")
+
+# smaller files are encoded in place, mmap does not pay off
+DEFER_MIN_SIZE = 64 * 1024
+# source bytes per base64 step, a multiple of 3 so that no chunk but
+# the last one is padded
+ENCODE_CHUNK = 3 * 1024 * 1024
+# placeholder for a deferred attachment in the json document, the
+# random part makes collisions with user data impossible in practice
+BLOB_TOKEN = "hippodclient-blob-{}-".format(binascii.hexlify(os.urandom(8)).decode())
+BLOB_TOKEN_RE = re.compile(re.escape(BLOB_TOKEN.encode()) + rb"(\d+)")
+_blob_ids = itertools.count()
+
+
+class PendingFile(object):
+    """ File attachment encoded when the test is serialized
+
+    content holds the file read when it was added, None for lazy files:
+    nothing but the name is kept in memory and the file is read at
+    upload time. Either way the AttachmentPolicy of the Container is
+    applied at upload time.
+    """
+
+    def __init__(self, path, mime_type, content=None):
+        self.path = path
+        self.mime_type = mime_type
+        self.content = content
+
+    def open(self):
+        if self.content is not None:
+            return io.BytesIO(self.content)
+        return open(self.path, "rb")
+
+    def size(self):
+        if self.content is not None:
+            return len(self.content)
+        return os.path.getsize(self.path)
+
+    def key(self):
+        # identifies the attachment without reading it
+        if self.content is not None:
+            import hashlib
+            return [self.path, self.mime_type, hashlib.sha1(self.content).hexdigest()]
+        st = os.stat(self.path)
+        return [self.path, self.mime_type, st.st_size, st.st_mtime]
+
+    def entry(self, encoder=None):
+        return (encoder or AttachmentEncoder(None)).encode(self)
+
+
+def is_text(mime_type):
+    return mime_type.startswith("text/") or mime_type in TEXT_MIME_TYPES
+
+
+def png_optimize(data):
+    """ Lossless PNG re-optimization
+
+    All IDAT chunks are merged and recompressed with the best zlib
+    level, metadata chunks are dropped. Returns the original data if
+    this does not save anything or the data is no valid PNG.
+    """
+    if not data.startswith(PNG_SIGNATURE):
+        return data
+    chunks = list()
+    idat = list()
+    offset = len(PNG_SIGNATURE)
+    try:
+        while offset < len(data):
+            length, = struct.unpack(">I", data[offset:offset + 4])
+            kind = data[offset + 4:offset + 8]
+            body = data[offset + 8:offset + 8 + length]
+            offset += 12 + length
+            if kind == b"IDAT":
+                if not idat:
+                    chunks.append((b"IDAT", None))
+                idat.append(body)
+            elif kind not in PNG_DROP_CHUNKS:
+                chunks.append((kind, body))
+        raw = zlib.decompress(b"".join(idat))
+    except (struct.error, zlib.error):
+        return data
+    compressor = zlib.compressobj(9, zlib.DEFLATED, 15, 9)
+    image = compressor.compress(raw) + compressor.flush()
+    out = [PNG_SIGNATURE]
+    for kind, body in chunks:
+        if body is None:
+            body = image
+        out.append(struct.pack(">I", len(body)))
+        out.append(kind)
+        out.append(body)
+        out.append(struct.pack(">I", zlib.crc32(kind + body) & 0xffffffff))
+    optimized = b"".join(out)
+    if len(optimized) >= len(data):
+        return data
+    return optimized
+
+
+def text_head_tail(f, size, limit, head_ratio=TEXT_HEAD_RATIO):
+    """ Read head and tail of a text file, at most limit bytes in total,
+    None if not even the trim marker fits into limit.
+    """
+    room = limit - len(TRIM_MARKER.format(size))
+    if room < 0:
+        return None
+    head_size = int(room * head_ratio)
+    tail_size = room - head_size
+    f.seek(0)
+    head = f.read(head_size)
+    # cut at line boundaries, the marker is on a line of its own
+    if b"\n" in head:
+        head = head[:head.rindex(b"\n")]
+    tail = b""
+    if tail_size:
+        f.seek(size - tail_size)
+        tail = f.read(tail_size)
+        if b"\n" in tail:
+            tail = tail[tail.index(b"\n") + 1:]
+    marker = TRIM_MARKER.format(size - len(head) - len(tail)).encode()
+    return head + marker + tail
+
+
+def pcap_slice(f, limit):
+    """ Return the pcap global header and all packets fitting into limit,
+    None if this is no (classic) pcap file or not even the header fits.
+    """
+    if limit < PCAP_GLOBAL_HEADER:
+        return None
+    f.seek(0)
+    header = f.read(PCAP_GLOBAL_HEADER)
+    if len(header) < PCAP_GLOBAL_HEADER or header[:4] not in PCAP_MAGICS:
+        return None
+    endian = "<" if header[:4] in (b"\xd4\xc3\xb2\xa1", b"\x4d\x3c\xb2\xa1") else ">"
+    parts = [header]
+    size = len(header)
+    while True:
+        record = f.read(PCAP_RECORD_HEADER)
+        if len(record) < PCAP_RECORD_HEADER:
+            break
+        incl_len, = struct.unpack(endian + "I", record[8:12])
+        if size + PCAP_RECORD_HEADER + incl_len > limit:
+            break
+        parts.append(record)
+        parts.append(f.read(incl_len))
+        size += PCAP_RECORD_HEADER + incl_len
+    return b"".join(parts)
+
+
+def b64_size(size):
+    return (size + 2) // 3 * 4
+
+
+def b64encode_into(src, dst):
+    """ Base64 encode the buffer src chunk by chunk into the buffer dst """
+    with memoryview(src) as src:
+        pos = 0
+        for start in range(0, len(src), ENCODE_CHUNK):
+            chunk = binascii.b2a_base64(src[start:start + ENCODE_CHUNK], newline=False)
+            dst[pos:pos + len(chunk)] = chunk
+            pos += len(chunk)
+
+
+def b64encode_file_into(pending, size, dst):
+    """ Base64 encode the PendingFile pending into the writable buffer dst
+
+    Lazy files are memory mapped, neither the file content nor its
+    encoding exist as a whole besides dst.
+    """
+    if pending.content is not None:
+        b64encode_into(pending.content, dst)
+        return
+    with open(pending.path, "rb") as f:
+        if os.fstat(f.fileno()).st_size != size:
+            emsg = "File '{}' changed while uploading".format(pending.path)
+            raise ArgumentException(emsg)
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+            b64encode_into(m, dst)
+
+
+def assemble(document, blobs):
+    """ Return the request body for a json document with blob placeholders
+
+    blobs maps the placeholder ids to (PendingFile, size). The body is allocated
+    once with its final size, the placeholders are replaced by the base64
+    encoded files directly within it.
+    """
+    document = document.encode()
+    parts = list()
+    size = len(document)
+    offset = 0
+    for match in BLOB_TOKEN_RE.finditer(document):
+        pending, blob_size = blobs[int(match.group(1))]
+        parts.append((document[offset:match.start()], pending, blob_size))
+        size += b64_size(blob_size) - (match.end() - match.start())
+        offset = match.end()
+    body = bytearray(size)
+    with memoryview(body) as view:
+        pos = 0
+        for text, pending, blob_size in parts:
+            view[pos:pos + len(text)] = text
+            pos += len(text)
+            b64_end = pos + b64_size(blob_size)
+            b64encode_file_into(pending, blob_size, view[pos:b64_end])
+            pos = b64_end
+        view[pos:] = document[offset:]
+    return body
+
+
+class AttachmentPolicy(object):
+    """ Bounds for file attachments, applied while encoding
+
+    max_entry_size: bytes per attachment, max_test_size: bytes of all
+    attachments of one test (None: unlimited). Attachments above the
+    limit are trimmed: text keeps head and tail, pcap files keep the
+    first packets, other data is replaced by a short note. PNG images
+    are losslessly re-optimized first if png_optimize is set.
+
+    Every modification is recorded in self.report.
+    """
+
+    def __init__(self, max_entry_size=None, max_test_size=None,
+                 text_head_ratio=TEXT_HEAD_RATIO, png_optimize=True):
+        self.max_entry_size = max_entry_size
+        self.max_test_size = max_test_size
+        self.text_head_ratio = text_head_ratio
+        self.png_optimize = png_optimize
+        self.report = list()
+
+    def encoder(self, title=None):
+        """ Encoder for the attachments of one test """
+        return AttachmentEncoder(self, title)
+
+    def _record(self, title, name, action, size, new_size):
+        d = dict()
+        d["test"] = title
+        d["name"] = name
+        d["action"] = action
+        d["size"] = size
+        d["new-size"] = new_size
+        self.report.append(d)
+
+
+class AttachmentEncoder(object):
+    """ Encodes the attachments of one test, policy None: no limits
+
+    With deferred set, large files the policy leaves unmodified are not
+    read at all: a placeholder takes the place of their data and the
+    file is recorded in self.blobs, see assemble().
+    """
+
+    def __init__(self, policy, title=None, deferred=False):
+        self.policy = policy
+        self.title = title
+        self.remaining = policy.max_test_size if policy else None
+        self.blobs = dict() if deferred else None
+
+    def _limit(self):
+        limits = [l for l in (self.policy.max_entry_size, self.remaining) if l is not None]
+        if not limits:
+            return None
+        return max(min(limits), 0)
+
+    def _unmodified(self, mime_type, size):
+        # True if the policy passes the file as it is
+        if self.policy is None:
+            return True
+        if mime_type == "image/png" and self.policy.png_optimize:
+            return False
+        limit = self._limit()
+        return limit is None or size <= limit
+
+    def _read(self, pending):
+        # returns (mime type, content), content bounded by the policy
+        mime_type = pending.mime_type
+        if self.policy is None:
+            if pending.content is not None:
+                return mime_type, pending.content
+            with pending.open() as f:
+                return mime_type, f.read()
+        name = os.path.basename(pending.path)
+        size = pending.size()
+        limit = self._limit()
+        record = self.policy._record
+        with pending.open() as f:
+            if mime_type == "image/png" and self.policy.png_optimize and \
+               (limit is None or size <= 4 * limit):
+                data = png_optimize(f.read())
+                if len(data) < size:
+                    record(self.title, name, "png-optimize", size, len(data))
+                if limit is None or len(data) <= limit:
+                    return mime_type, data
+            elif limit is None or size <= limit:
+                return mime_type, f.read()
+            if is_text(mime_type):
+                data = text_head_tail(f, size, limit, self.policy.text_head_ratio)
+                if data is not None:
+                    record(self.title, name, "head-tail", size, len(data))
+                    return mime_type, data
+            data = pcap_slice(f, limit)
+            if data is not None:
+                record(self.title, name, "pcap-slice", size, len(data))
+                return mime_type, data
+        note = "[{} ({}, {} bytes) omitted by hippodclient, limit {} bytes]"
+        data = note.format(name, mime_type, size, limit).encode()
+        record(self.title, name, "omitted", size, len(data))
+        return "text/plain", data
+
+    def encode(self, pending):
+        if pending.content is None and not os.path.isfile(pending.path):
+            emsg = "File '{}' is not available".format(pending.path)
+            raise ArgumentException(emsg)
+        size = pending.size()
+        entry = dict()
+        entry["name"] = os.path.basename(pending.path)
+        if self.blobs is not None and size >= DEFER_MIN_SIZE and \
+           self._unmodified(pending.mime_type, size):
+            blob_id = next(_blob_ids)
+            self.blobs[blob_id] = (pending, size)
+            entry["mime-type"] = pending.mime_type
+            entry["data"] = BLOB_TOKEN + str(blob_id)
+        else:
+            mime_type, data = self._read(pending)
+            size = len(data)
+            entry["mime-type"] = mime_type
+            entry["data"] = base64.b64encode(data).decode()
+        if self.remaining is not None:
+            self.remaining -= size
+        return entry
@@ -0,0 +1,198 @@
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import time
+import base64
+import shutil
+import tempfile
+import subprocess
+
+from hippodclient.hippodclient import Container, Test
+
+
+def synthetic_documents(count, payload=0):
+    """ Return count serialized tests, each with payload bytes of data """
+    documents = list()
+    for i in range(count):
+        t = Test()
+        t.submitter_set("anonymous")
+        t.title_set("Benchmark {}".format(i))
+        t.categories_set("team:bench", "synthetic")
+        t.achievement.result_set("passed", date="2016-01-01T00:00:00")
+        if payload:
+            t.description_plain_set(base64.b64encode(os.urandom(payload * 3 // 4)).decode())
+        documents.append(t.json())
+    return documents
+
+
+STARTUP_SNIPPET = """
+import hippodclient
+t = hippodclient.Test()
+t.title_set("startup")
+t.categories_set("team:startup")
+c = hippodclient.Container(url="http://127.0.0.1/")
+c.add(t)
+"""
+
+
+def bench_import(snippet=STARTUP_SNIPPET):
+    """ Run snippet in a fresh interpreter with python -X importtime
+
+    Returns a dict of module name -> (self, cumulative) import time in
+    seconds for every module imported by the snippet.
+    """
+    cmd = [sys.executable, "-X", "importtime", "-c", snippet]
+    proc = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                          universal_newlines=True, check=True)
+    modules = dict()
+    for line in proc.stderr.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        fields = line[len("import time:"):].split("|")
+        if len(fields) != 3 or not fields[0].strip().isdigit():
+            continue
+        name = fields[2].strip()
+        # everything before the first import of the snippet is
+        # interpreter startup (site, encodings, ...)
+        if name == "site":
+            modules = dict()
+            continue
+        modules[name] = (int(fields[0]) / 1e6, int(fields[1]) / 1e6)
+    return modules
+
+
+def bench_transport(url, transports, count=1000, concurrency=8, payload=0):
+    """ Upload the same synthetic tests with every transport
+
+    Returns a list of dicts with the numbers per transport.
+    """
+    documents = synthetic_documents(count, payload)
+    size = sum(len(d) for d in documents)
+    results = list()
+    for name in transports:
+        if name == "memory":
+            from hippodclient.transport import MemoryTransport
+            transport = MemoryTransport(record=False)
+        else:
+            transport = name
+        c = Container(url=url, transport=transport, concurrency=concurrency)
+        c._check_pre_sync()
+        start = time.time()
+        ret = c.loop.run_until_complete(c._send_all(documents))
+        elapsed = max(time.time() - start, 1e-9)
+        d = dict()
+        d["transport"] = name
+        d["requests"] = count
+        d["failed"] = len([r for r in ret if not r[0]])
+        d["seconds"] = elapsed
+        d["requests/s"] = count / elapsed
+        d["MiB/s"] = size / elapsed / (1 << 20)
+        results.append(d)
+    return results
+
+
+def print_results(results, stream=sys.stdout):
+    if not results:
+        return
+    keys = list(results[0].keys())
+    rows = [keys]
+    for d in results:
+        row = list()
+        for key in keys:
+            value = d[key]
+            if isinstance(value, float):
+                value = "{:.2f}".format(value)
+            row.append(str(value))
+        rows.append(row)
+    widths = [max(len(row[i]) for row in rows) for i in range(len(keys))]
+    for row in rows:
+        stream.write("  ".join(v.rjust(w) for v, w in zip(row, widths)) + "\n")
+
+
+def bench_pytest(count=10000, modules=100, url="http://127.0.0.1/"):
+    """ Run a synthetic suite of count tests with and without the pytest
+    plugin (memory transport), returns a list of dicts with the numbers.
+    """
+    tmpdir = tempfile.mkdtemp()
+    try:
+        per_module = max(count // modules, 1)
+        for m in range(modules):
+            path = os.path.join(tmpdir, "test_synthetic_{}.py".format(m))
+            with open(path, "w") as fd:
+                for i in range(per_module):
+                    fd.write("def test_{}():\n    assert {} % 7 != 6\n\n".format(i, i))
+        env = dict(os.environ)
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        env["PYTHONPATH"] = os.pathsep.join(p for p in (root, env.get("PYTHONPATH")) if p)
+        base = [sys.executable, "-m", "pytest", "-q", "-p", "no:cacheprovider", tmpdir]
+        from hippodclient.pytest_plugin import PLUGIN_ARGS
+        runs = [("without plugin", ["-p", "no:hippodclient"]),
+                ("with plugin", PLUGIN_ARGS + ["--hippod-url", url,
+                                               "--hippod-transport", "memory"])]
+        results = list()
+        for name, args in runs:
+            start = time.time()
+            proc = subprocess.run(base + args, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                  env=env, cwd=tmpdir)
+            # 1: some synthetic tests fail on purpose
+            if proc.returncode not in (0, 1):
+                raise subprocess.CalledProcessError(proc.returncode, base + args,
+                                                    output=proc.stdout)
+            d = dict()
+            d["run"] = name
+            d["tests"] = per_module * modules
+            d["seconds"] = time.time() - start
+            results.append(d)
+        overhead = results[1]["seconds"] - results[0]["seconds"]
+        results[1]["overhead %"] = 100.0 * overhead / results[0]["seconds"]
+        results[0]["overhead %"] = 0.0
+        return results
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def bench_encode(sizes, tmpdir=None):
+    """ Serialize a test with one file attachment of every size (MiB)
+
+    Compares json().encode(), the request body built from copies, with
+    body() encoding the memory mapped (lazy) file into the preallocated
+    body.
+    Returns a list of dicts with throughput and peak memory allocated
+    while encoding.
+    """
+    import tracemalloc
+    tmpdir = tempfile.mkdtemp(dir=tmpdir)
+    try:
+        results = list()
+        for size in sizes:
+            path = os.path.join(tmpdir, "attachment-{}.bin".format(size))
+            with open(path, "wb") as f:
+                for _ in range(size):
+                    f.write(os.urandom(1 << 20))
+            t = Test()
+            t.submitter_set("anonymous")
+            t.title_set("Encode {} MiB".format(size))
+            t.categories_set("team:bench", "encode")
+            t.data_file_add(path, lazy=True)
+            methods = [("json", lambda: t.json().encode()), ("body", t.body)]
+            for name, method in methods:
+                tracemalloc.start()
+                start = time.time()
+                body = method()
+                elapsed = max(time.time() - start, 1e-9)
+                _, peak = tracemalloc.get_traced_memory()
+                tracemalloc.stop()
+                del body
+                d = dict()
+                d["MiB"] = size
+                d["method"] = name
+                d["seconds"] = elapsed
+                d["MiB/s"] = size / elapsed
+                d["peak MiB"] = peak / (1 << 20)
+                d["peak/body"] = peak / ((size << 20) * 4 / 3)
+                results.append(d)
+            os.unlink(path)
+        return results
+    finally:
+        shutil.rmtree(tmpdir)
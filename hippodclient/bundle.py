@@ -0,0 +1,406 @@
+# -*- coding: utf-8 -*-
+
+import os
+import re
+import gzip
+import json
+import uuid
+import zlib
+import hashlib
+
+
+BUNDLE_VERSION = 1
+JOURNAL_SUFFIX = ".done"
+INDEX_SUFFIX = ".blobs"
+
+# uncompressed bytes per gzip member, members are the unit of sharding
+MEMBER_SIZE = 4 * 1024 * 1024
+CHUNK_SIZE = 64 * 1024
+
+RECORD_HEADER = "header"
+RECORD_BLOB = "blob"
+RECORD_TEST = "test"
+
+
+# blob records start with type and id, so the id is known without
+# decoding the payload. Older bundles with sorted keys are decoded.
+BLOB_PREFIX = re.compile(rb'^\{"type":"blob","id":"([0-9a-f]+)"')
+
+
+class BundleException(Exception): pass
+
+
+def _blob_id(line):
+    match = BLOB_PREFIX.match(line)
+    if match is None:
+        return None
+    return match.group(1).decode()
+
+
+def _blob_data(line):
+    return json.loads(line.decode())["data"]
+
+
+def _member_lines(fd, offset, path):
+    """ Yield the lines of the gzip member at offset, returns the offset
+    of the next member. Only this member is decompressed.
+    """
+    fd.seek(offset)
+    d = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    buf = bytearray()
+    try:
+        while not d.eof:
+            chunk = fd.read(CHUNK_SIZE)
+            if not chunk:
+                raise BundleException("Bundle '{}' truncated".format(path))
+            buf += d.decompress(chunk)
+            end = buf.rfind(b"\n")
+            if end < 0:
+                continue
+            for line in bytes(buf[:end]).split(b"\n"):
+                line = line.strip()
+                if line:
+                    yield line
+            del buf[:end + 1]
+    except zlib.error as e:
+        raise BundleException("Bundle '{}' corrupt: {}".format(path, e))
+    line = bytes(buf).strip()
+    if line:
+        yield line
+    return fd.tell() - len(d.unused_data)
+
+
+def _iter_data_entries(doc):
+    # object-item data and all achievement data entries carry the
+    # (possibly large) base64 payloads
+    for entry in doc.get("object-item", {}).get("data", []):
+        yield entry
+    for achievement in doc.get("achievements", []):
+        for entry in achievement.get("data", []):
+            yield entry
+
+
+class BundleWriter(object):
+    """ Append-only writer for gzip compressed NDJSON bundles.
+
+    Records are appended as gzip members of about member_size
+    uncompressed bytes, so a bundle can be extended by several exports
+    and still be read in one pass, or member by member in parallel.
+    Each distinct attachment payload is stored exactly once as blob
+    record, test records reference it by content hash. The ids of all
+    stored blobs and the member offsets are kept in an index file next
+    to the bundle.
+    """
+
+    def __init__(self, path, member_size=None):
+        self.path = path
+        self.member_size = member_size or MEMBER_SIZE
+        self.blobs = set()
+        self.new_blobs = list()
+        self.new_members = list()
+        self.raw = None
+        self.fd = None
+
+    def open(self):
+        exists = os.path.isfile(self.path) and os.path.getsize(self.path) > 0
+        if exists:
+            # learn already stored blobs, we never write them twice
+            self.blobs = index_load(self.path)
+        elif os.path.isfile(index_path(self.path)):
+            # left over from a removed bundle
+            os.unlink(index_path(self.path))
+        self.raw = open(self.path, "ab")
+        self._member()
+        if not exists:
+            self._write({"type": RECORD_HEADER, "version": BUNDLE_VERSION})
+
+    def _member(self):
+        if self.fd:
+            self.fd.close()
+        self.offset = self.raw.tell()
+        self.new_members.append(self.offset)
+        self.fd = gzip.GzipFile(fileobj=self.raw, mode="ab")
+        self.written = 0
+        self.member_tests = 0
+
+    def close(self):
+        if self.fd:
+            self.fd.close()
+            self.fd = None
+            self.raw.close()
+            self.raw = None
+            # after the gzip members are complete, a crash in between
+            # leaves a stale index which is rebuilt on the next open()
+            index_append(self.path, self.new_blobs, self.new_members)
+            self.new_blobs = list()
+            self.new_members = list()
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _write(self, record, sort_keys=True):
+        line = json.dumps(record, sort_keys=sort_keys, separators=(',', ':'))
+        self.fd.write(line.encode())
+        self.fd.write(b"\n")
+        self.written += len(line) + 1
+
+    def add(self, json_data):
+        """ Add one serialized test (as returned by Test.json()) """
+        if self.member_tests and self.written >= self.member_size:
+            # a test and its new blobs always share one member
+            self._member()
+        doc = json.loads(json_data)
+        for entry in _iter_data_entries(doc):
+            data = entry.pop("data", None)
+            if data is None:
+                continue
+            blob_id = hashlib.sha1(data.encode()).hexdigest()
+            if blob_id not in self.blobs:
+                record = dict()
+                record["type"] = RECORD_BLOB
+                record["id"] = blob_id
+                record["data"] = data
+                self._write(record, sort_keys=False)
+                self.blobs.add(blob_id)
+                self.new_blobs.append((blob_id, self.offset))
+            entry["data-ref"] = blob_id
+        record_id = uuid.uuid4().hex
+        self._write({"type": RECORD_TEST, "id": record_id, "doc": doc})
+        self.member_tests += 1
+        return record_id
+
+
+class BundleReader(object):
+    """ Iterate over all records of a bundle """
+
+    def __init__(self, path):
+        if not os.path.isfile(path):
+            emsg = "Bundle '{}' is not available".format(path)
+            raise BundleException(emsg)
+        self.path = path
+
+    def _scan(self, offsets=None):
+        # (member offset, line) of the given or of all members
+        with open(self.path, "rb") as fd:
+            if offsets is not None:
+                for offset in offsets:
+                    for line in _member_lines(fd, offset, self.path):
+                        yield offset, line
+                return
+            size = os.fstat(fd.fileno()).st_size
+            offset = 0
+            while offset < size:
+                lines = _member_lines(fd, offset, self.path)
+                while True:
+                    try:
+                        line = next(lines)
+                    except StopIteration as e:
+                        # the offset of the next member
+                        end = e.value
+                        break
+                    yield offset, line
+                offset = end
+
+    def _lines(self):
+        for _, line in self._scan():
+            yield line
+
+    def _record(self, line):
+        try:
+            record = json.loads(line.decode())
+        except ValueError as e:
+            raise BundleException("Bundle '{}' corrupt: {}".format(self.path, e))
+        if record.get("type") == RECORD_HEADER:
+            if record.get("version") != BUNDLE_VERSION:
+                emsg = "Bundle version {} not supported"
+                raise BundleException(emsg.format(record.get("version")))
+        return record
+
+    def __iter__(self):
+        for line in self._lines():
+            yield self._record(line)
+
+    def index(self):
+        """ Return ({blob id: member offset}, [member offsets]) read from
+        the bundle, blob payloads are not decoded
+        """
+        blobs = dict()
+        members = list()
+        for offset, line in self._scan():
+            if not members or members[-1] != offset:
+                members.append(offset)
+            blob_id = _blob_id(line)
+            if blob_id is None:
+                record = self._record(line)
+                if record["type"] != RECORD_BLOB:
+                    continue
+                blob_id = record["id"]
+            blobs.setdefault(blob_id, offset)
+        return blobs, members
+
+    def blob_ids(self):
+        """ Return the set of ids of all blobs, payloads are not decoded """
+        return set(self.index()[0])
+
+    def _fetch(self, blob_ids, index):
+        # decode blobs stored in other members, each member is read once
+        offsets = dict()
+        for blob_id in blob_ids:
+            if blob_id not in index:
+                emsg = "Bundle '{}' corrupt, blob {} missing"
+                raise BundleException(emsg.format(self.path, blob_id))
+            offsets.setdefault(index[blob_id], set()).add(blob_id)
+        blobs = dict()
+        for offset in sorted(offsets):
+            for _, line in self._scan([offset]):
+                blob_id = _blob_id(line)
+                if blob_id in offsets[offset]:
+                    blobs[blob_id] = _blob_data(line)
+                elif blob_id is None:
+                    record = self._record(line)
+                    if record["type"] == RECORD_BLOB and record["id"] in offsets[offset]:
+                        blobs[record["id"]] = record["data"]
+        return blobs
+
+    def tests(self, shard=0, shards=1):
+        """ Yield (record id, json data) for all tests of this shard
+
+        Shards are formed of whole gzip members, a shard decompresses
+        only its own members and decodes only the blobs its tests
+        reference. Blobs stored once in another member are fetched from
+        there and kept for the following members of this shard.
+        """
+        index, members = index_read(self.path)
+        shared = dict()
+        for offset in members[shard::shards]:
+            lines = dict()
+            records = list()
+            for _, line in self._scan([offset]):
+                blob_id = _blob_id(line)
+                if blob_id is not None:
+                    lines[blob_id] = line
+                    continue
+                record = self._record(line)
+                if record["type"] == RECORD_BLOB:
+                    lines[record["id"]] = line
+                elif record["type"] == RECORD_TEST:
+                    records.append(record)
+            refs = set()
+            for record in records:
+                for entry in _iter_data_entries(record["doc"]):
+                    if "data-ref" in entry:
+                        refs.add(entry["data-ref"])
+            missing = refs - set(lines) - set(shared)
+            shared.update(self._fetch(missing, index))
+            blobs = dict()
+            for record in records:
+                doc = record["doc"]
+                for entry in _iter_data_entries(doc):
+                    blob_id = entry.pop("data-ref", None)
+                    if blob_id is None:
+                        continue
+                    if blob_id in lines:
+                        if blob_id not in blobs:
+                            blobs[blob_id] = _blob_data(lines[blob_id])
+                        entry["data"] = blobs[blob_id]
+                    else:
+                        entry["data"] = shared[blob_id]
+                yield record["id"], json.dumps(doc, sort_keys=True, separators=(',', ': '))
+
+
+def index_path(path):
+    return path + INDEX_SUFFIX
+
+
+def index_read(path):
+    """ Return ({blob id: member offset}, [member offsets]) of the bundle
+
+    The index lists the blobs and members of every export followed by
+    the bundle size it describes. If it is missing or does not match
+    the bundle it is rebuilt from the bundle (without decoding the
+    payloads).
+    """
+    ipath = index_path(path)
+    if os.path.isfile(ipath):
+        blobs = dict()
+        members = list()
+        size = None
+        valid = True
+        with open(ipath, "r") as fd:
+            for line in fd:
+                fields = line.split()
+                if len(fields) != 2:
+                    # empty or written by an older version
+                    valid = valid and not fields
+                elif fields[0] == "size":
+                    size = int(fields[1])
+                elif fields[0] == "member":
+                    members.append(int(fields[1]))
+                else:
+                    blobs.setdefault(fields[0], int(fields[1]))
+        if valid and size == os.path.getsize(path):
+            return blobs, members
+    blobs, members = BundleReader(path).index()
+    # write aside and rename, concurrent readers see the old or new index
+    tmp = "{}.{}.tmp".format(ipath, os.getpid())
+    with open(tmp, "w") as fd:
+        _index_write(fd, path, sorted(blobs.items()), members)
+    os.replace(tmp, ipath)
+    return blobs, members
+
+
+def index_load(path):
+    """ Return the set of blob ids stored in the bundle path """
+    return set(index_read(path)[0])
+
+
+def _index_write(fd, path, blobs, members):
+    for offset in members:
+        fd.write("member {}\n".format(offset))
+    for blob_id, offset in blobs:
+        fd.write("{} {}\n".format(blob_id, offset))
+    fd.write("size {}\n".format(os.path.getsize(path)))
+
+
+def index_append(path, blobs, members):
+    with open(index_path(path), "a") as fd:
+        _index_write(fd, path, blobs, members)
+
+
+def journal_path(path):
+    return path + JOURNAL_SUFFIX
+
+
+def journal_load(path):
+    """ Return the set of already uploaded record ids of a bundle """
+    done = set()
+    jpath = journal_path(path)
+    if not os.path.isfile(jpath):
+        return done
+    with open(jpath, "r") as fd:
+        for line in fd:
+            line = line.strip()
+            if line:
+                done.add(line)
+    return done
+
+
+class Journal(object):
+    """ Append-only list of uploaded record ids, one per line
+
+    Lines are short and written with O_APPEND, so several replay
+    workers can share one journal file.
+    """
+
+    def __init__(self, path):
+        self.fd = os.open(journal_path(path), os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+
+    def add(self, record_id):
+        os.write(self.fd, "{}\n".format(record_id).encode())
+
+    def close(self):
+        os.close(self.fd)
@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+
+import time
+
+from hippodclient.hippodclient import ArgumentException
+
+
+STRATEGY_LEAST_OUTSTANDING = "least-outstanding"
+STRATEGY_ROUND_ROBIN = "round-robin"
+STRATEGIES = (STRATEGY_LEAST_OUTSTANDING, STRATEGY_ROUND_ROBIN)
+
+# consecutive failures until an endpoint is ejected
+FAILURE_THRESHOLD = 3
+# seconds until an ejected endpoint is probed again
+RESET_TIMEOUT = 10.0
+
+STATE_CLOSED = "closed"
+STATE_OPEN = "open"
+STATE_HALF_OPEN = "half-open"
+
+
+class Endpoint(object):
+    """ One HippoD server with passive health and request metrics """
+
+    def __init__(self, url, weight=1):
+        if weight < 1:
+            raise ArgumentException("endpoint weight must be >= 1, not {}".format(weight))
+        self.url = url
+        self.weight = weight
+        self.state = STATE_CLOSED
+        self.opened_at = 0
+        self.consecutive_failures = 0
+        self.outstanding = 0
+        self.requests = 0
+        self.failures = 0
+        self.ejections = 0
+        self.latency = 0.0
+        # smooth weighted round robin state
+        self.current_weight = 0
+
+    def full_url(self, path):
+        seperator = "/"
+        if self.url.endswith("/"): seperator = ""
+        return "{}{}{}".format(self.url, seperator, path)
+
+    def stats(self):
+        d = dict()
+        d["url"] = self.url
+        d["weight"] = self.weight
+        d["state"] = self.state
+        d["outstanding"] = self.outstanding
+        d["requests"] = self.requests
+        d["failures"] = self.failures
+        d["ejections"] = self.ejections
+        d["latency-avg"] = self.latency / self.requests if self.requests else 0.0
+        return d
+
+
+class EndpointPool(object):
+    """ Distribute requests over several endpoints
+
+    Endpoints failing failure_threshold times in a row are ejected
+    (circuit open). After reset_timeout seconds one probe request is
+    let through (half-open), a success brings the endpoint back. With
+    all endpoints ejected requests still go out, a single flaky server
+    must not fail the rest of a sync.
+    """
+
+    def __init__(self, urls, strategy=STRATEGY_LEAST_OUTSTANDING,
+                 failure_threshold=FAILURE_THRESHOLD, reset_timeout=RESET_TIMEOUT):
+        if strategy not in STRATEGIES:
+            emsg = "strategy must be one of {}, not {}".format(", ".join(STRATEGIES), strategy)
+            raise ArgumentException(emsg)
+        self.strategy = strategy
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.endpoints = list()
+        for url in urls:
+            if isinstance(url, (tuple, list)):
+                endpoint = Endpoint(*url)
+            else:
+                endpoint = Endpoint(url)
+            self.endpoints.append(endpoint)
+        if not self.endpoints:
+            raise ArgumentException("at least one endpoint required")
+
+    def __len__(self):
+        return len(self.endpoints)
+
+    def _available(self, endpoint, now):
+        if endpoint.state == STATE_CLOSED:
+            return True
+        if endpoint.state == STATE_OPEN and now - endpoint.opened_at >= self.reset_timeout:
+            return True
+        # half-open: exactly one probe is in flight
+        return False
+
+    def _pick_least_outstanding(self, candidates):
+        return min(candidates, key=lambda e: (e.outstanding / e.weight, e.requests / e.weight))
+
+    def _pick_round_robin(self, candidates):
+        # nginx style smooth weighted round robin
+        total = 0
+        best = None
+        for endpoint in candidates:
+            endpoint.current_weight += endpoint.weight
+            total += endpoint.weight
+            if best is None or endpoint.current_weight > best.current_weight:
+                best = endpoint
+        best.current_weight -= total
+        return best
+
+    def acquire(self, exclude=()):
+        """ Return the endpoint for the next request or None if all are excluded
+
+        Ejected endpoints are avoided, not refused: if no other endpoint
+        is left the one ejected longest ago is probed anyway.
+        """
+        now = time.time()
+        remaining = [e for e in self.endpoints if e not in exclude]
+        if not remaining:
+            return None
+        candidates = [e for e in remaining if self._available(e, now)]
+        if not candidates:
+            endpoint = min(remaining, key=lambda e: e.opened_at)
+        elif self.strategy == STRATEGY_ROUND_ROBIN:
+            endpoint = self._pick_round_robin(candidates)
+        else:
+            endpoint = self._pick_least_outstanding(candidates)
+        if endpoint.state == STATE_OPEN:
+            endpoint.state = STATE_HALF_OPEN
+        endpoint.outstanding += 1
+        endpoint.requests += 1
+        return endpoint
+
+    def release(self, endpoint, ok, latency=0.0):
+        endpoint.outstanding -= 1
+        endpoint.latency += latency
+        if ok:
+            endpoint.consecutive_failures = 0
+            endpoint.state = STATE_CLOSED
+            return
+        endpoint.failures += 1
+        endpoint.consecutive_failures += 1
+        if endpoint.state == STATE_HALF_OPEN or \
+           endpoint.consecutive_failures >= self.failure_threshold:
+            if endpoint.state != STATE_OPEN:
+                endpoint.ejections += 1
+            endpoint.state = STATE_OPEN
+            endpoint.opened_at = time.time()
+
+    def stats(self):
+        return [endpoint.stats() for endpoint in self.endpoints]
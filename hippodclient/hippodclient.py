@@ -1,20 +1,20 @@
 # -*- coding: utf-8 -*-
 
 import json
-import pprint
 import base64
 import re
 import os
 import sys
 import datetime
-import mimetypes
-import getpass
-import textwrap
-import asyncio
-import aiohttp
+import time
+
+# Everything else (asyncio, the networking stack, mimetypes, getpass, ...)
+# is imported on first use: many users just build one Test in a short
+# lived process, there the import time dominates.
 
 
 REQUEST_TIMEOUT = 5
+REQUEST_CONCURRENCY = 8
 
 
 # custom exceptions
@@ -22,6 +22,7 @@ class ArgumentException(Exception): pass
 class ConfigurationException(Exception): pass
 class InternalException(Exception): pass
 class TransformException(Exception): pass
+class TransportException(Exception): pass
 
 PASSED = "passed"
 FAILED = "failed"
@@ -40,6 +41,7 @@ def create_file_entry(file_name, mime_type):
             raise ArgumentException(emsg)
 
         if not mime_type:
+            import mimetypes
             mime_type, _ = mimetypes.guess_type(file_name)
             if mime_type is None:
                 mime_type = TestMimeTypes.guess_type(file_name)
@@ -54,7 +56,7 @@ def create_file_entry(file_name, mime_type):
         entry["data"] = file_content.decode()
         return entry
 
-def create_snippet_entry(file_name, mime_type, name):
+def create_snippet_entry(file_name, mime_type, name, render=False):
         if not os.path.isfile(file_name):
             emsg = "File '{}' is not available".format(file_name)
             raise ArgumentException(emsg)
@@ -63,6 +65,11 @@ def create_snippet_entry(file_name, mime_type, name):
                    " - for now. Not: {}".format(mime_type)
             raise ArgumentException(emsg)
 
+        if render:
+            # rendered to PNG right before upload, see snippets.py
+            from hippodclient.snippets import PendingSnippet
+            return PendingSnippet(file_name, name)
+
         with open(file_name, "rb") as f:
             file_content = base64.b64encode(f.read())
 
@@ -74,6 +81,47 @@ def create_snippet_entry(file_name, mime_type, name):
 
         return entry
 
+_default_submitter = None
+
+def default_submitter():
+    """ Name of the logged in user, looked up once per process """
+    global _default_submitter
+    if _default_submitter is None:
+        import getpass
+        _default_submitter = getpass.getuser()
+    return _default_submitter
+
+def create_pending_file(file_name, mime_type, lazy=False):
+        """ Like create_file_entry() but the file is encoded on serialization,
+        lazy files are read not before then.
+        """
+        if not os.path.isfile(file_name):
+            emsg = "File '{}' is not available".format(file_name)
+            raise ArgumentException(emsg)
+
+        if not mime_type:
+            import mimetypes
+            mime_type, _ = mimetypes.guess_type(file_name)
+            if mime_type is None:
+                mime_type = TestMimeTypes.guess_type(file_name)
+
+        content = None
+        if not lazy:
+            with open(file_name, "rb") as f:
+                content = f.read()
+
+        from hippodclient.attachments import PendingFile
+        return PendingFile(file_name, mime_type, content)
+
+def encode_data(data, encoder=None):
+    # file attachments are read and encoded not before now
+    entries = list()
+    for entry in data:
+        if not isinstance(entry, dict):
+            entry = entry.entry(encoder)
+        entries.append(entry)
+    return entries
+
 def has_invalid_character(string):
     return not bool(re.match("^[a-z0-9-:]*$", string))
 
@@ -87,6 +135,7 @@ def to_list(args):
 class TestMimeTypes():
     types_map = dict()
     types_map[".pcap"] = 'application/vnd.tcpdump.pcap'
+    types_map[".log"] = 'text/plain'
 
 
     @staticmethod
@@ -108,49 +157,210 @@ class Container(object):
     # URL path
     URL_API_OBJECTS = "api/v1/object"
 
-    def __init__(self, url=None, timeout=REQUEST_TIMEOUT):
+    def __init__(self, url=None, timeout=REQUEST_TIMEOUT, concurrency=REQUEST_CONCURRENCY,
+                 strategy="least-outstanding", transport="aiohttp", debug=False,
+                 snippet_renderer=None, attachment_policy=None, coalesce=True):
+        """ url is one HippoD server URL or a list of URLs (or (url, weight)
+        tuples). Uploads are distributed over all servers according to
+        strategy: "least-outstanding" or "round-robin" (weighted).
+
+        transport is "aiohttp" (HTTP/1.1, default), "http2" (httpx,
+        multiplexed), "memory" (no network) or a Transport instance.
+
+        snippet_renderer is used for snippets added with render=True,
+        by default a SnippetRenderer with the user cache directory.
+
+        attachment_policy (an attachments.AttachmentPolicy) bounds the
+        size of file attachments, by default files are sent unmodified.
+
+        With coalesce tests sharing submitter, object-item and attachment
+        are uploaded as one object with all their achievements.
+        """
+        from hippodclient.transport import create_transport
         self._init_defaults()
         self.timeout = timeout
-        self.url = url
-        self.loop = asyncio.get_event_loop()
+        self.concurrency = concurrency
+        self.strategy = strategy
+        self.transport = create_transport(transport)
+        self.debug = debug
+        self.snippet_renderer = snippet_renderer
+        self.attachment_policy = attachment_policy
+        self.coalesce = coalesce
+        self.set_url(url)
+        self._loop = None
+
+    @property
+    def loop(self):
+        # created on first use, constructing a Container is cheap
+        if self._loop is None:
+            import asyncio
+            try:
+                self._loop = asyncio.get_event_loop()
+            except RuntimeError:
+                self._loop = asyncio.new_event_loop()
+                asyncio.set_event_loop(self._loop)
+        return self._loop
 
     def _init_defaults(self):
         self.tests = list()
+        self.user_agent_headers = {'Content-type': 'application/json',
+                                   'Accept': 'application/json',
+                                   'User-Agent' : 'Hippodclient/1.0+'
+                                   }
 
     def set_url(self, url):
         self.url = url
+        self.endpoints = None
 
     def add(self, test):
         self.tests.append(test)
 
     def _check_pre_sync(self):
-        if not self.url:
+        if not self.url and self.transport.requires_url:
             raise ConfigurationException("no hippod server URL specified")
+        if self.endpoints is None:
+            from hippodclient.endpoints import EndpointPool
+            # e.g. the relay transport, the relay knows the servers
+            urls = self.url or self.transport.name
+            if not isinstance(urls, list):
+                urls = [urls]
+            self.endpoints = EndpointPool(urls, strategy=self.strategy)
+
+    def endpoint_stats(self):
+        """ Per-endpoint health and request metrics as list of dicts """
+        if self.endpoints is None:
+            return list()
+        return self.endpoints.stats()
 
     async def _send_data(self, data):
-        self.user_agent_headers = {'Content-type': 'application/json',
-                                   'Accept': 'application/json',
-                                   'User-Agent' : 'Hippodclient/1.0+'
-                                   }
-        seperator = "/"
-        if self.url.endswith("/"): seperator = ""
-        full_url = "{}{}{}".format(self.url, seperator, "api/v1/object")
-        data = str.encode(data)
-        async with aiohttp.ClientSession() as session:
-            async with session.post(full_url, data=data) as resp:
-                print("Response: {}".format(resp.status))
-        return (True, None)
+        if isinstance(data, str):
+            data = data.encode()
+        # fail over to the next healthy endpoint on connection
+        # errors and server errors, client errors are final
+        tried = list()
+        emsg = "no healthy hippod server available"
+        while True:
+            endpoint = self.endpoints.acquire(exclude=tried)
+            if endpoint is None:
+                return (False, emsg)
+            tried.append(endpoint)
+            full_url = endpoint.full_url(self.URL_API_OBJECTS)
+            start = time.time()
+            # a transport without url (relay) is no server, its errors
+            # and backpressure (503) must not open the circuit breaker
+            tracked = self.transport.requires_url
+            try:
+                status = await self.transport.post(full_url, data, self.user_agent_headers)
+            except TransportException as e:
+                self.endpoints.release(endpoint, not tracked, time.time() - start)
+                emsg = str(e)
+                continue
+            if self.debug:
+                print("Response: {}".format(status))
+            self.endpoints.release(endpoint, status < 500 or not tracked, time.time() - start)
+            if status < 300:
+                return (True, None)
+            emsg = "HTTP status {}".format(status)
+            if status < 500:
+                return (False, emsg)
+
+    async def _send_all(self, documents, callback=None):
+        """ Upload json documents over the transport
+
+        documents may be any iterable or async iterable, it is consumed
+        lazily and at most self.concurrency requests are in flight.
+        Returns the list of (ok, error) tuples. If a callback is given it
+        is called with (index, ret) as soon as a single upload finished
+        and nothing is collected (documents may be endless).
+        """
+        import asyncio
+        semaphore = asyncio.Semaphore(self.concurrency)
+        ret_list = list()
+        tasks = set()
+
+        async def send(index, data):
+            try:
+                ret = await self._send_data(data)
+            finally:
+                semaphore.release()
+            if callback:
+                callback(index, ret)
+            else:
+                ret_list[index] = ret
+
+        async def start(index, data):
+            await semaphore.acquire()
+            if not callback:
+                ret_list.append(None)
+            task = asyncio.ensure_future(send(index, data))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+
+        await self.transport.open(self.concurrency, self.timeout)
+        try:
+            index = 0
+            if hasattr(documents, "__aiter__"):
+                async for data in documents:
+                    await start(index, data)
+                    index += 1
+            else:
+                for data in documents:
+                    await start(index, data)
+                    index += 1
+            if tasks:
+                await asyncio.gather(*tasks)
+        finally:
+            await self.transport.close()
+        if not callback:
+            return ret_list
+
+    def _render_snippets(self):
+        # render all snippets of all tests in one parallel batch
+        # instead of one after another in Test.json()
+        if any(test._pending_snippets() for test in self.tests):
+            from hippodclient.snippets import render_pending
+            render_pending(self.tests, self.snippet_renderer)
+
+    def _groups(self):
+        # list of test lists, each list is uploaded as one document,
+        # and the group index of every test in self.tests
+        if not self.coalesce:
+            return [[test] for test in self.tests], list(range(len(self.tests)))
+        groups = dict()
+        owners = list()
+        for test in self.tests:
+            group = groups.setdefault(test._coalesce_key(), (len(groups), list()))
+            group[1].append(test)
+            owners.append(group[0])
+        return [group for _, group in groups.values()], owners
+
+    def _documents(self, groups):
+        for group in groups:
+            yield group[0].body(self.attachment_policy, coalesced=group[1:])
 
     def sync(self):
+        """ Upload all tests, returns one (ok, error) tuple per test """
         self._check_pre_sync()
-        ret_list = list()
-        for test in self.tests:
-            json_data = test.json()
-            ret = self.loop.run_until_complete(self._send_data(json_data))
-            ret_list.append(ret)
-        return ret_list
+        self._render_snippets()
+        groups, owners = self._groups()
+        ret_list = self.loop.run_until_complete(self._send_all(self._documents(groups)))
+        return [ret_list[owner] for owner in owners]
     # just an alias for sync
 
+    def export(self, path):
+        """ Append all queued tests to an offline bundle
+
+        The bundle can be uploaded later via python -m hippodclient replay.
+        Returns the list of record ids written to the bundle, one per test.
+        """
+        from hippodclient.bundle import BundleWriter
+        self._render_snippets()
+        groups, owners = self._groups()
+        with BundleWriter(path) as writer:
+            ids = [writer.add(group[0].json(self.attachment_policy, coalesced=group[1:]))
+                   for group in groups]
+        return [ids[owner] for owner in owners]
+
 
 class Test(object):
 
@@ -176,6 +386,8 @@ class Test(object):
             self._tags_cleanup()
 
         def tags_add(self, *tags):
+            # never modify lists in place, they may be shared with clones
+            self.tags = list(self.tags)
             tags = to_list(tags)
             for tag in tags:
                 if has_invalid_character(tag):
@@ -198,6 +410,7 @@ class Test(object):
             self._references_cleanup()
 
         def references_add(self, *references):
+            self.references = list(self.references)
             references = to_list(references)
             for reference in references:
                 self.references.append(reference)
@@ -217,6 +430,14 @@ class Test(object):
             d["responsible"] = self.responsible
             return d
 
+        def clone(self):
+            # lists are shared, all modifications replace them
+            a = Test.Attachment.__new__(Test.Attachment)
+            a.tags = self.tags
+            a.references = self.references
+            a.responsible = self.responsible
+            return a
+
 
 
     class Achievement(object):
@@ -224,7 +445,6 @@ class Test(object):
         def __init__(self):
             self.result = DEFAULT_RESULT
             self.test_date = datetime.datetime.now().isoformat('T')
-            print("The date is ", self.test_date)
             self.data = list()
             self.anchor = None
 
@@ -242,20 +462,28 @@ class Test(object):
                 raise ArgumentException("anchor must be an string, not {}".format(type(anchor)))
             self.anchor = anchor
 
-        def data_file_add(self, filepath, mime_type=None):
-            entry = create_file_entry(filepath, mime_type)
-            self.data.append(entry)
+        def data_file_add(self, filepath, mime_type=None, lazy=False):
+            entry = create_pending_file(filepath, mime_type, lazy)
+            self.data = self.data + [entry]
 
-        def snippet_file_add(self, filepath, type, name=None):
-            entry = create_snippet_entry(filepath, type, name)
-            self.data.append(entry)
+        def snippet_file_add(self, filepath, type, name=None, render=False):
+            entry = create_snippet_entry(filepath, type, name, render)
+            self.data = self.data + [entry]
 
-        def transform(self):
+        def clone(self):
+            a = Test.Achievement.__new__(Test.Achievement)
+            a.result = self.result
+            a.test_date = datetime.datetime.now().isoformat('T')
+            a.data = self.data
+            a.anchor = self.anchor
+            return a
+
+        def transform(self, encoder=None):
             root = dict()
             root["result"] = self.result
             root["test-date"] = self.test_date
             if len(self.data) > 0:
-                root["data"] = self.data
+                root["data"] = encode_data(self.data, encoder)
             if self.anchor:
                 root["anchor"] = self.anchor
             return root
@@ -266,7 +494,8 @@ class Test(object):
 
 
     def init_defaults(self):
-        self.submitter = getpass.getuser()
+        # resolved on serialization, see default_submitter()
+        self.submitter = None
         self.title = None
         self.categories = list()
         self.data = list()
@@ -276,6 +505,28 @@ class Test(object):
         self.init_defaults()
         self.attachment = Test.Attachment()
         self.achievement = Test.Achievement()
+        # serialized object-item and attachment, shared with clones
+        self._fragments = dict()
+
+    def clone(self):
+        """ Return a new test with all fields of this test
+
+        Use a fully prepared test as template for many similar tests:
+        submitter, categories, data (description, attachments), tags
+        and references are not copied but shared copy-on-write, the
+        serialized object-item and attachment are reused as long as a
+        clone does not modify them. Only the achievement date is new.
+        """
+        t = Test.__new__(Test)
+        t.debug = self.debug
+        t.submitter = self.submitter
+        t.title = self.title
+        t.categories = self.categories
+        t.data = self.data
+        t.attachment = self.attachment.clone()
+        t.achievement = self.achievement.clone()
+        t._fragments = self._fragments
+        return t
 
     def submitter_set(self, submitter):
         val_type = type(submitter)
@@ -290,19 +541,22 @@ class Test(object):
             mime_type = "text/plain"
 
         if detent == True:
+            import textwrap
             description = textwrap.dedent(description)
 
         # iterate over data structure and if a description
         # is alread there: remove and overwrite
-        for i in range(len(self.data)):
-            if self.data[i]["type"] == "description":
-                del self.data[i]
+        data = list(self.data)
+        for i in range(len(data)):
+            if isinstance(data[i], dict) and data[i].get("type") == "description":
+                del data[i]
                 break
         data_item = dict()
         data_item["type"] = "description"
         data_item["mime-type"] = mime_type
         data_item["data"] = (base64.b64encode(description.encode())).decode()
-        self.data.append(data_item)
+        data.append(data_item)
+        self.data = data
 
     def description_markdown_set(self, description):
         self.description_set(description, type="markdown", detent=True)
@@ -313,13 +567,32 @@ class Test(object):
     def title_set(self, title):
         self.title = title
 
-    def data_file_add(self, filepath, mime_type=None):
-        entry = create_file_entry(filepath, mime_type)
-        self.data.append(entry)
-
-    def snippet_file_add(self, filepath, type, name=None):
-        entry = create_snippet_entry(filepath, type, name)
-        self.data.append(entry)
+    def data_file_add(self, filepath, mime_type=None, lazy=False):
+        """ Attach a file, it is read right now. lazy files are read at
+        upload time instead, large files are then never held in memory
+        but must not be changed or removed until the upload.
+        """
+        entry = create_pending_file(filepath, mime_type, lazy)
+        self.data = self.data + [entry]
+
+    def snippet_file_add(self, filepath, type, name=None, render=False):
+        """ Add a snippet script. With render=True the script is executed
+        by the client and the resulting PNG is attached instead.
+        """
+        entry = create_snippet_entry(filepath, type, name, render)
+        self.data = self.data + [entry]
+
+    def _pending_snippets(self):
+        # (owner of the data list, index, snippet) of not yet rendered snippets
+        pending = list()
+        for owner in (self, self.achievement):
+            for index, entry in enumerate(owner.data):
+                if isinstance(entry, dict):
+                    continue
+                from hippodclient.snippets import PendingSnippet
+                if isinstance(entry, PendingSnippet):
+                    pending.append((owner, index, entry))
+        return pending
 
     def categories_set(self, *categories):
         self.categories = list()
@@ -331,7 +604,7 @@ class Test(object):
                 raise ArgumentException(emsg)
             self.categories.append(category)
 
-    def transform(self):
+    def transform(self, encoder=None):
         d = dict()
         if not self.title:
             emsg = "test case inpure, title missing"
@@ -343,21 +616,122 @@ class Test(object):
         d["categories"] = self.categories
         d["version"] = 0
         if len(self.data) > 0:
-            d["data"] = self.data
+            d["data"] = encode_data(self.data, encoder)
         return d
 
-    def json(self):
-        root = dict()
-        root["submitter"] = self.submitter
-        root["achievements"] = list()
-        root["achievements"].append(self.achievement.transform())
-
-        root["attachment"] = self.attachment.transform()
-
-        root["object-item"] = self.transform()
-        pprint.pprint(root)
-        return json.dumps(root, sort_keys=True, separators=(',', ': '))
-
+    def _coalesce_key(self):
+        """ Tests with identical key share one object document """
+        cached = self._fragments.get("data-key")
+        if cached and cached[0] is self.data:
+            data = cached[1]
+        else:
+            data = list()
+            for entry in self.data:
+                if isinstance(entry, dict):
+                    data.append(entry)
+                else:
+                    data.append(entry.key())
+            data = json.dumps(data, sort_keys=True)
+            self._fragments["data-key"] = (self.data, data)
+        key = [self.submitter or default_submitter(), self.title, self.categories]
+        return json.dumps(key) + data + self._attachment_json()
+
+    def _object_item_json(self, encoder, policy):
+        # cached as long as title, categories and data are unchanged,
+        # they are never modified in place but replaced. Fragments with
+        # encoded file data are not cached: they may be large and the
+        # policy report must list every trimmed file again.
+        blobs = encoder.blobs if encoder else None
+        cached = self._fragments.get("object-item")
+        if cached and cached[0] == self.title and cached[1] is self.categories \
+           and cached[2] is self.data and cached[3] is policy \
+           and (cached[6] is None) == (blobs is None):
+            if encoder:
+                encoder.remaining = cached[5]
+                if blobs is not None:
+                    blobs.update(cached[6])
+            return cached[4]
+        known = len(blobs) if blobs is not None else 0
+        fragment = json.dumps(self.transform(encoder), sort_keys=True, separators=(',', ': '))
+        files = len([entry for entry in self.data if not isinstance(entry, dict)])
+        deferred = len(blobs) - known if blobs is not None else 0
+        if files > deferred:
+            self._fragments.pop("object-item", None)
+            return fragment
+        remaining = encoder.remaining if encoder else None
+        if blobs is not None:
+            blobs = dict(blobs)
+        self._fragments["object-item"] = (self.title, self.categories, self.data, policy,
+                                          fragment, remaining, blobs)
+        return fragment
+
+    def _attachment_json(self):
+        a = self.attachment
+        cached = self._fragments.get("attachment")
+        if cached and cached[0] is a.tags and cached[1] is a.references \
+           and cached[2] == a.responsible:
+            return cached[3]
+        fragment = json.dumps(a.transform(), sort_keys=True, separators=(',', ': '))
+        self._fragments["attachment"] = (a.tags, a.references, a.responsible, fragment)
+        return fragment
+
+    def _serialize(self, policy, coalesced, deferred):
+        # returns the json document and the blobs of deferred attachments
+        if self._pending_snippets():
+            from hippodclient.snippets import render_pending
+            render_pending([self])
+        blobs = dict()
+
+        def encoder(title):
+            if not policy and not deferred:
+                return None
+            from hippodclient.attachments import AttachmentEncoder
+            return AttachmentEncoder(policy, title, deferred)
+
+        # assembled from fragments, identical to json.dumps() of the
+        # whole document with sort_keys. object-item data comes first in
+        # the attachment budget.
+        e = encoder(self.title)
+        object_item = self._object_item_json(e, policy)
+        achievements = [self.achievement.transform(e)]
+        if deferred:
+            blobs.update(e.blobs)
+        for test in coalesced:
+            e = encoder(test.title)
+            achievements.append(test.achievement.transform(e))
+            if deferred:
+                blobs.update(e.blobs)
+        parts = list()
+        parts.append('"achievements": ' + json.dumps(achievements, sort_keys=True,
+                                                      separators=(',', ': ')))
+        parts.append('"attachment": ' + self._attachment_json())
+        parts.append('"object-item": ' + object_item)
+        parts.append('"submitter": ' + json.dumps(self.submitter or default_submitter()))
+        data = "{" + ",".join(parts) + "}"
+        if self.debug:
+            import pprint
+            pprint.pprint(json.loads(data))
+        return data, blobs
+
+    def json(self, policy=None, coalesced=()):
+        """ Serialize the test, file attachments are bounded by the
+        AttachmentPolicy policy if given. The achievements of all tests
+        in coalesced are added to this object document.
+        """
+        return self._serialize(policy, coalesced, False)[0]
+
+    def body(self, policy=None, coalesced=()):
+        """ Like json() but returns the encoded request body as bytearray
+
+        Large file attachments are memory mapped and base64 encoded
+        straight into the preallocated body, without copies of the file
+        content or its encoding.
+        """
+        data, blobs = self._serialize(policy, coalesced, True)
+        if not blobs:
+            return bytearray(data.encode())
+        from hippodclient.attachments import assemble
+        return assemble(data, blobs)
 
 if __name__ == "__main__":
     sys.stderr.write("Python client library to interact with HippoD\n")
@@ -0,0 +1,220 @@
+# -*- coding: utf-8 -*-
+""" pytest plugin uploading test results to HippoD
+
+Enabled with --hippod-url (or --hippod-export for offline bundles).
+Results are handed to a background uploader as soon as a test finished,
+test execution never waits for the network. With pytest-xdist only the
+controller process uploads: workers forward their reports anyway, so one
+uploader per host serves all workers.
+"""
+
+import re
+import base64
+import threading
+
+from hippodclient.hippodclient import Test, Container, PASSED, FAILED, NONAPPLICABLE, EXCEPTION
+
+
+# load the plugin explicitly, e.g. in subprocesses of the tests and
+# benchmarks. The entry point of an installed hippodclient is blocked,
+# it would register the same module a second time.
+PLUGIN_ARGS = ["-p", "no:hippodclient", "-p", "hippodclient.pytest_plugin"]
+
+# tests uploaded per request batch, coalesced where possible
+BATCH_SIZE = 256
+# seconds a batch waits for more tests
+BATCH_INTERVAL = 1.0
+# seconds to wait for pending uploads at the end of the session
+DRAIN_TIMEOUT = 60.0
+
+
+def pytest_addoption(parser):
+    group = parser.getgroup("hippod", "upload test results to HippoD")
+    group.addoption("--hippod-url", action="append", default=None,
+                    help="HippoD server URL, repeat to balance over several servers")
+    group.addoption("--hippod-export", default=None,
+                    help="write results to an offline bundle instead")
+    group.addoption("--hippod-category", default="pytest",
+                    help="first category level, the test module path follows")
+    group.addoption("--hippod-submitter", default=None)
+    group.addoption("--hippod-transport", default="aiohttp",
+                    choices=["aiohttp", "http2", "h2c", "memory", "relay"])
+
+
+def pytest_configure(config):
+    if not config.getoption("hippod_url") and not config.getoption("hippod_export"):
+        return
+    if hasattr(config, "workerinput"):
+        # xdist worker, the controller uploads
+        return
+    reporter = HippodReporter(config)
+    config.pluginmanager.register(reporter, "hippod-reporter")
+
+
+def sanitize(name):
+    # categories only allow [a-z0-9-:]
+    return re.sub("[^a-z0-9-:]+", "-", name.lower()).strip("-") or "-"
+
+
+def report_to_test(nodeid, result, longrepr, category, submitter):
+    """ Map one finished pytest item to a Test
+
+    Parametrized items share the title, the parameter id is stored as
+    achievement anchor. So all parameters of a test are coalesced into
+    one object with many achievements.
+    """
+    path, _, name = nodeid.partition("::")
+    param = None
+    if name.endswith("]") and "[" in name:
+        name, _, param = name[:-1].partition("[")
+    module = path[:-3] if path.endswith(".py") else path
+    t = Test()
+    if submitter:
+        t.submitter_set(submitter)
+    t.title_set(name.replace("::", "."))
+    t.categories_set([sanitize(category)] + [sanitize(p) for p in module.split("/") if p])
+    t.achievement.result_set(result)
+    if param is not None:
+        t.achievement.anchor_set(param)
+    if longrepr:
+        entry = dict()
+        entry["name"] = "failure.txt"
+        entry["mime-type"] = "text/plain"
+        entry["data"] = base64.b64encode(longrepr.encode()).decode()
+        t.achievement.data.append(entry)
+    return t
+
+
+class Uploader(object):
+    """ Uploads tests from a background thread in batches
+
+    add() never blocks. The uploader thread runs one long-lived upload
+    over the Container's transport (and connection pool) for the whole
+    session; tests are serialized there, coalesced per batch.
+    """
+
+    def __init__(self, container):
+        import asyncio
+        self.container = container
+        self.loop = asyncio.new_event_loop()
+        self.container._loop = self.loop
+        # created in the uploader thread, before the loop runs
+        self.queue = None
+        self.added = 0
+        self.results = list()
+        # group size per uploaded document, indexed like _send_all
+        self.group_sizes = list()
+        self.thread = threading.Thread(target=self._run, name="hippod-uploader", daemon=True)
+        self.thread.start()
+
+    def _put(self, test):
+        self.queue.put_nowait(test)
+
+    def add(self, test):
+        self.added += 1
+        self.loop.call_soon_threadsafe(self._put, test)
+
+    async def _next_batch(self):
+        # the next tests, None at the end of the session
+        import asyncio
+        test = await self.queue.get()
+        if test is None:
+            return None
+        batch = [test]
+        deadline = self.loop.time() + BATCH_INTERVAL
+        while len(batch) < BATCH_SIZE:
+            if self.queue.empty():
+                timeout = deadline - self.loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    test = await asyncio.wait_for(self.queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+            else:
+                test = self.queue.get_nowait()
+            if test is None:
+                # end of session, flush this batch first
+                self.queue.put_nowait(None)
+                break
+            batch.append(test)
+        return batch
+
+    async def _documents(self):
+        while True:
+            batch = await self._next_batch()
+            if batch is None:
+                return
+            self.container.tests = batch
+            groups, _ = self.container._groups()
+            for group in groups:
+                self.group_sizes.append(len(group))
+                yield group[0].body(self.container.attachment_policy, coalesced=group[1:])
+
+    def _uploaded(self, index, ret):
+        self.results.extend([ret] * self.group_sizes[index])
+
+    def _run(self):
+        import asyncio
+        asyncio.set_event_loop(self.loop)
+        self.queue = asyncio.Queue()
+        try:
+            self.loop.run_until_complete(
+                    self.container._send_all(self._documents(), self._uploaded))
+        except Exception as e:
+            # e.g. transport not available, all tests not uploaded so far failed
+            self.results.extend([(False, str(e))] * (self.added - len(self.results)))
+
+    def close(self, timeout=DRAIN_TIMEOUT):
+        self.loop.call_soon_threadsafe(self._put, None)
+        self.thread.join(timeout)
+
+class HippodReporter(object):
+
+    def __init__(self, config):
+        self.config = config
+        self.category = config.getoption("hippod_category")
+        self.submitter = config.getoption("hippod_submitter")
+        self.export = config.getoption("hippod_export")
+        self.container = Container(url=config.getoption("hippod_url"),
+                                   transport=config.getoption("hippod_transport"))
+        self.uploader = None
+        if not self.export:
+            self.container._check_pre_sync()
+            self.uploader = Uploader(self.container)
+        # nodeid -> (result, longrepr) until the teardown report
+        self.outcomes = dict()
+
+    def pytest_runtest_logreport(self, report):
+        result, longrepr = self.outcomes.get(report.nodeid, (PASSED, None))
+        if report.failed:
+            if report.when == "call" and not hasattr(report, "wasxfail"):
+                result = FAILED
+            elif result == PASSED:
+                result = EXCEPTION
+            longrepr = longrepr or str(report.longrepr)
+        elif report.skipped and result == PASSED:
+            result = NONAPPLICABLE
+        if report.when != "teardown":
+            self.outcomes[report.nodeid] = (result, longrepr)
+            return
+        self.outcomes.pop(report.nodeid, None)
+        test = report_to_test(report.nodeid, result, longrepr, self.category, self.submitter)
+        if self.uploader:
+            self.uploader.add(test)
+        else:
+            self.container.add(test)
+
+    def pytest_sessionfinish(self, session):
+        if self.export:
+            self.container.export(self.export)
+            return
+        self.uploader.close()
+
+    def pytest_terminal_summary(self, terminalreporter):
+        if self.export:
+            msg = "{} tests exported to {}".format(len(self.container.tests), self.export)
+        else:
+            failed = len([r for r in self.uploader.results if not r[0]])
+            msg = "{} tests uploaded, {} failed".format(len(self.uploader.results) - failed, failed)
+        terminalreporter.write_sep("-", "hippod: " + msg)
@@ -0,0 +1,207 @@
+# -*- coding: utf-8 -*-
+""" Host-local relay aggregating the uploads of many jobs
+
+Local Containers with transport="relay" hand their serialized tests over
+a Unix domain socket to the relay; it acknowledges them as soon as they
+are queued and forwards them upstream over one small, shared connection
+pool.
+
+Frames on the socket are a 4 byte big-endian length followed by a zlib
+compressed JSON document. Requests are lists of serialized tests, the
+reply is the list of per-test status codes (202: queued, 503: queue
+full).
+
+Tests the relay could not upload are retried with exponential backoff.
+If the upstream servers stay unreachable, or the relay is stopped while
+uploads are pending, the tests are spooled to an offline bundle, upload
+them later with python -m hippodclient replay. Queued tests are not
+written to disk until then: if the relay itself crashes, they are lost.
+"""
+
+import os
+import sys
+import json
+import zlib
+import struct
+import asyncio
+
+from hippodclient.hippodclient import Container, TransportException
+
+
+SOCKET_ENV = "HIPPOD_RELAY_SOCKET"
+QUEUE_SIZE = 10000
+UPSTREAM_CONCURRENCY = 4
+# upload attempts per test before it is spooled
+RETRIES = 5
+# seconds before the first retry, doubled for every further retry
+RETRY_DELAY = 1.0
+RETRY_DELAY_MAX = 60.0
+# upper bound of a frame, protects the relay against garbage
+FRAME_MAX = 1 << 30
+
+STATUS_QUEUED = 202
+STATUS_QUEUE_FULL = 503
+
+
+def default_socket_path():
+    if os.environ.get(SOCKET_ENV):
+        return os.environ[SOCKET_ENV]
+    runtime_dir = os.environ.get("XDG_RUNTIME_DIR")
+    if runtime_dir:
+        return os.path.join(runtime_dir, "hippodclient-relay.sock")
+    return "/tmp/hippodclient-relay-{}.sock".format(os.getuid())
+
+
+def default_spool_path():
+    base = os.environ.get("XDG_STATE_HOME") or \
+           os.path.join(os.path.expanduser("~"), ".local", "state")
+    return os.path.join(base, "hippodclient", "relay-spool.ndjson.gz")
+
+
+async def read_frame(reader):
+    """ Return the next decoded frame, None on end of stream """
+    try:
+        header = await reader.readexactly(4)
+    except asyncio.IncompleteReadError:
+        return None
+    length, = struct.unpack(">I", header)
+    if length > FRAME_MAX:
+        raise TransportException("relay frame too large: {} bytes".format(length))
+    payload = await reader.readexactly(length)
+    return json.loads(zlib.decompress(payload).decode())
+
+
+def write_frame(writer, obj):
+    payload = zlib.compress(json.dumps(obj).encode())
+    writer.write(struct.pack(">I", len(payload)) + payload)
+
+
+class Relay(object):
+    """ The relay daemon, upstream uploads go through an own Container """
+
+    def __init__(self, url, path=None, concurrency=UPSTREAM_CONCURRENCY,
+                 queue_size=QUEUE_SIZE, spool=None, retries=RETRIES,
+                 retry_delay=RETRY_DELAY, **container_args):
+        self.path = path or default_socket_path()
+        self.spool = spool or default_spool_path()
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.container = Container(url=url, concurrency=concurrency, **container_args)
+        self.container._check_pre_sync()
+        self.queue_size = queue_size
+        self.server = None
+        self.queue = None
+        self.forwarder = None
+        self.stopping = False
+        # index of _send_all -> (data, attempt) of running uploads
+        self.sending = dict()
+        self.sent = 0
+        # retry task -> data, waiting for the next attempt
+        self.retrying = dict()
+        self.stats = {"connections": 0, "frames": 0, "received": 0, "rejected": 0,
+                      "forwarded": 0, "failed": 0, "retried": 0, "spooled": 0}
+
+    async def _handle(self, reader, writer):
+        self.stats["connections"] += 1
+        try:
+            while True:
+                documents = await read_frame(reader)
+                if documents is None:
+                    break
+                self.stats["frames"] += 1
+                status = list()
+                for data in documents:
+                    try:
+                        self.queue.put_nowait((data, 1))
+                        self.stats["received"] += 1
+                        status.append(STATUS_QUEUED)
+                    except asyncio.QueueFull:
+                        self.stats["rejected"] += 1
+                        status.append(STATUS_QUEUE_FULL)
+                write_frame(writer, status)
+                await writer.drain()
+        except (ConnectionError, TransportException, ValueError, zlib.error,
+                asyncio.IncompleteReadError) as e:
+            sys.stderr.write("relay: dropping client: {}\n".format(e))
+        finally:
+            writer.close()
+
+    async def _documents(self):
+        while True:
+            item = await self.queue.get()
+            if item is None:
+                return
+            # _send_all numbers the documents in the order they are
+            # yielded, its callback gets this index
+            self.sending[self.sent] = item
+            self.sent += 1
+            yield item[0]
+
+    def _uploaded(self, index, ret):
+        data, attempt = self.sending.pop(index)
+        ok, emsg = ret
+        if ok:
+            self.stats["forwarded"] += 1
+            return
+        self.stats["failed"] += 1
+        if self.stopping or attempt >= self.retries:
+            self._spool([data], emsg)
+            return
+        self.stats["retried"] += 1
+        task = asyncio.ensure_future(self._retry(data, attempt))
+        self.retrying[task] = data
+        task.add_done_callback(lambda t: self.retrying.pop(t, None))
+
+    async def _retry(self, data, attempt):
+        delay = min(self.retry_delay * 2 ** (attempt - 1), RETRY_DELAY_MAX)
+        await asyncio.sleep(delay)
+        await self.queue.put((data, attempt + 1))
+
+    def _spool(self, documents, emsg):
+        from hippodclient.bundle import BundleWriter
+        os.makedirs(os.path.dirname(os.path.abspath(self.spool)), exist_ok=True)
+        with BundleWriter(self.spool) as writer:
+            for data in documents:
+                writer.add(data)
+        self.stats["spooled"] += len(documents)
+        msg = "relay: upload failed ({}), {} tests spooled to {}\n"
+        sys.stderr.write(msg.format(emsg, len(documents), self.spool))
+
+    async def start(self):
+        self.queue = asyncio.Queue(self.queue_size)
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        self.server = await asyncio.start_unix_server(self._handle, path=self.path)
+        os.chmod(self.path, 0o600)
+        # one endless upload over the shared connection pool
+        self.forwarder = asyncio.ensure_future(
+                self.container._send_all(self._documents(), self._uploaded))
+
+    async def stop(self):
+        """ Stop accepting tests and forward everything queued, tests
+        failing now or waiting for a retry are spooled.
+        """
+        self.server.close()
+        await self.server.wait_closed()
+        self.stopping = True
+        waiting = list()
+        for task, data in list(self.retrying.items()):
+            # done: already queued again
+            if not task.done():
+                task.cancel()
+                waiting.append(data)
+        if waiting:
+            self._spool(waiting, "relay stopped")
+        await self.queue.put(None)
+        await self.forwarder
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+    def run(self):
+        loop = self.container.loop
+        loop.run_until_complete(self.start())
+        try:
+            loop.run_forever()
+        except KeyboardInterrupt:
+            pass
+        loop.run_until_complete(self.stop())
@@ -0,0 +1,198 @@
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import base64
+import hashlib
+
+from hippodclient.hippodclient import TransformException
+
+
+# bump to invalidate all cached renderings
+RENDER_VERSION = 1
+CACHE_MAX_BYTES = 256 * 1024 * 1024
+# recycle workers, user scripts may leak memory or global state
+TASKS_PER_WORKER = 64
+
+
+def default_cache_dir():
+    base = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(base, "hippodclient", "snippets")
+
+
+class PendingSnippet(object):
+    """ Placeholder in a data list for a snippet rendered before upload """
+
+    def __init__(self, path, name=None):
+        self.path = path
+        self.name = name
+
+    def entry(self, png_path):
+        with open(png_path, "rb") as f:
+            file_content = base64.b64encode(f.read())
+        entry = dict()
+        entry["name"] = self.name or os.path.splitext(os.path.basename(self.path))[0] + ".png"
+        entry["mime-type"] = "image/png"
+        entry["data"] = file_content.decode()
+        return entry
+
+
+def _worker_init():
+    # import matplotlib once per worker with the headless backend,
+    # every script afterwards starts without the import cost
+    os.environ["MPLBACKEND"] = "Agg"
+    try:
+        import matplotlib
+        matplotlib.use("Agg")
+        import matplotlib.pyplot
+    except ImportError:
+        pass
+
+
+def _worker_render(task):
+    """ Execute one snippet script, it writes the PNG to sys.argv[1] """
+    import runpy
+    script, out = task
+    argv, cwd = sys.argv, os.getcwd()
+    sys.argv = [script, out]
+    try:
+        os.chdir(os.path.dirname(os.path.abspath(script)))
+        runpy.run_path(script, run_name="__main__")
+    except SystemExit as e:
+        # sys.exit() or sys.exit(0) after writing the PNG is fine
+        if e.code not in (None, 0):
+            return "SystemExit: {}".format(e.code)
+    except BaseException as e:
+        return "{}: {}".format(type(e).__name__, e)
+    finally:
+        sys.argv = argv
+        os.chdir(cwd)
+        plt = sys.modules.get("matplotlib.pyplot")
+        if plt:
+            plt.close("all")
+    if not os.path.isfile(out):
+        return "script wrote no output to sys.argv[1]"
+    return None
+
+
+class SnippetRenderer(object):
+    """ Render x-snippet-python3-matplot-png scripts to PNG on the client
+
+    Scripts are executed in a process pool with matplotlib preloaded
+    (Agg backend). Results are cached on disk keyed by the script
+    content, the least recently used renderings are evicted as soon as
+    the cache grows beyond max_cache_bytes.
+    """
+
+    def __init__(self, cache_dir=None, max_cache_bytes=CACHE_MAX_BYTES, processes=None):
+        self.cache_dir = os.path.abspath(cache_dir or default_cache_dir())
+        self.max_cache_bytes = max_cache_bytes
+        self.processes = processes or os.cpu_count() or 1
+        self.hits = 0
+        self.misses = 0
+
+    def _cache_path(self, script):
+        h = hashlib.sha256()
+        h.update("{}\0".format(RENDER_VERSION).encode())
+        with open(script, "rb") as f:
+            h.update(f.read())
+        return os.path.join(self.cache_dir, h.hexdigest() + ".png")
+
+    def _run(self, tasks):
+        """ Render tasks in the pool, returns one error (or None) per task """
+        from concurrent.futures import ProcessPoolExecutor
+        from concurrent.futures.process import BrokenProcessPool
+        processes = min(self.processes, len(tasks))
+        # a fresh pool every round recycles the workers
+        chunk = processes * TASKS_PER_WORKER
+        errors = list()
+        for start in range(0, len(tasks), chunk):
+            with ProcessPoolExecutor(processes, initializer=_worker_init) as pool:
+                try:
+                    errors.extend(pool.map(_worker_render, tasks[start:start + chunk]))
+                except BrokenProcessPool as e:
+                    # os._exit(), a segfault or the OOM killer in a script
+                    emsg = "snippet worker died: {}".format(e)
+                    raise TransformException(emsg)
+        return errors
+
+    def render(self, scripts):
+        """ Return the list of rendered PNG paths for the list of scripts """
+        os.makedirs(self.cache_dir, exist_ok=True)
+        paths = [self._cache_path(script) for script in scripts]
+        tasks = dict()
+        for script, path in zip(scripts, paths):
+            if path in tasks:
+                # identical script twice in this batch
+                self.hits += 1
+            elif os.path.isfile(path):
+                # refresh for LRU eviction
+                os.utime(path, None)
+                self.hits += 1
+            else:
+                # savefig() derives the format from the extension
+                tmp = "{}.{}.tmp.png".format(path[:-4], os.getpid())
+                tasks[path] = (os.path.abspath(script), tmp)
+        if tasks:
+            self.misses += len(tasks)
+            try:
+                errors = self._run(list(tasks.values()))
+            except TransformException:
+                for script, tmp in tasks.values():
+                    if os.path.isfile(tmp):
+                        os.unlink(tmp)
+                raise
+            failed = None
+            for (path, (script, tmp)), error in zip(tasks.items(), errors):
+                if error:
+                    failed = failed or "snippet {} failed: {}".format(script, error)
+                    if os.path.isfile(tmp):
+                        os.unlink(tmp)
+                    continue
+                os.replace(tmp, path)
+            if failed:
+                raise TransformException(failed)
+        self._evict(keep=set(paths))
+        return paths
+
+    def _evict(self, keep=()):
+        files = list()
+        total = 0
+        for name in os.listdir(self.cache_dir):
+            if not name.endswith(".png") or name.endswith(".tmp.png"):
+                continue
+            path = os.path.join(self.cache_dir, name)
+            st = os.stat(path)
+            files.append((st.st_mtime, st.st_size, path))
+            total += st.st_size
+        files.sort()
+        for _, size, path in files:
+            if total <= self.max_cache_bytes:
+                break
+            if path in keep:
+                continue
+            os.unlink(path)
+            total -= size
+
+
+def render_pending(tests, renderer=None):
+    """ Render all pending snippets of all tests in one parallel batch
+
+    Data lists may be shared with templates and clones, rendered entries
+    go into new lists which replace the old ones on every owner.
+    """
+    pending = list()
+    for test in tests:
+        pending.extend(test._pending_snippets())
+    if not pending:
+        return
+    renderer = renderer or SnippetRenderer()
+    paths = renderer.render([snippet.path for _, _, snippet in pending])
+    rendered = dict()
+    for (owner, index, snippet), path in zip(pending, paths):
+        old, data = rendered.setdefault(id(owner.data), (owner.data, list(owner.data)))
+        data[index] = snippet.entry(path)
+    for owner, _, _ in pending:
+        old, data = rendered.get(id(owner.data), (None, None))
+        if old is owner.data:
+            owner.data = data
@@ -0,0 +1,23 @@
+import os
+
+import hippodclient
+
+
+def data_path(name):
+    """ Path of a file shipped with the tests """
+    cwd = os.path.dirname(os.path.abspath(__file__))
+    return os.path.join(cwd, name)
+
+
+def image_path():
+    return data_path("graph.png")
+
+
+def gen_test(title, category, result="passed", date=None):
+    """ Minimal valid test in the categories team:foo, category """
+    t = hippodclient.Test()
+    t.submitter_set("anonymous")
+    t.title_set(title)
+    t.categories_set("team:foo", category)
+    t.achievement.result_set(result, date=date)
+    return t
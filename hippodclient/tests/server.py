@@ -0,0 +1,116 @@
+import json
+import threading
+import asyncio
+
+from aiohttp import web
+
+
+class Server(object):
+    """ Minimal HippoD stand-in collecting posted objects """
+
+    def __init__(self, status=201, fail_first=0):
+        self.status = status
+        # the first fail_first requests are answered with 503
+        self.fail_first = fail_first
+        self.received = list()
+        self.loop = asyncio.new_event_loop()
+        self.ready = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    async def _handler(self, request):
+        if self.fail_first > 0:
+            self.fail_first -= 1
+            return web.json_response({}, status=503)
+        self.received.append(await request.json())
+        return web.json_response({}, status=self.status)
+
+    def _run(self):
+        asyncio.set_event_loop(self.loop)
+        app = web.Application()
+        app.router.add_post("/api/v1/object", self._handler)
+        self.runner = web.AppRunner(app)
+        self.loop.run_until_complete(self.runner.setup())
+        site = web.TCPSite(self.runner, "127.0.0.1", 0)
+        self.loop.run_until_complete(site.start())
+        self.port = site._server.sockets[0].getsockname()[1]
+        self.ready.set()
+        self.loop.run_forever()
+
+    def start(self):
+        self.thread.start()
+        self.ready.wait()
+        return "http://127.0.0.1:{}/".format(self.port)
+
+    def stop(self):
+        asyncio.run_coroutine_threadsafe(self.runner.cleanup(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+
+
+class H2Protocol(asyncio.Protocol):
+    """ One cleartext HTTP/2 connection of H2Server """
+
+    def __init__(self, server):
+        import h2.config
+        import h2.connection
+        self.server = server
+        config = h2.config.H2Configuration(client_side=False)
+        self.conn = h2.connection.H2Connection(config=config)
+        self.bodies = dict()
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.server.connections += 1
+        self.conn.initiate_connection()
+        self.transport.write(self.conn.data_to_send())
+
+    def _respond(self, stream_id):
+        self.server.streams -= 1
+        self.conn.send_headers(stream_id, [(":status", str(self.server.status)),
+                                           ("content-length", "0")], end_stream=True)
+        self.transport.write(self.conn.data_to_send())
+
+    def data_received(self, data):
+        import h2.events
+        for event in self.conn.receive_data(data):
+            if isinstance(event, h2.events.RequestReceived):
+                self.bodies[event.stream_id] = list()
+                self.server.streams += 1
+                self.server.max_streams = max(self.server.max_streams, self.server.streams)
+            elif isinstance(event, h2.events.DataReceived):
+                self.bodies[event.stream_id].append(event.data)
+                self.conn.acknowledge_received_data(event.flow_controlled_length,
+                                                    event.stream_id)
+            elif isinstance(event, h2.events.StreamEnded):
+                body = b"".join(self.bodies.pop(event.stream_id))
+                self.server.received.append(json.loads(body.decode()))
+                self.server.loop.call_later(self.server.delay, self._respond, event.stream_id)
+            elif isinstance(event, h2.events.ConnectionTerminated):
+                self.transport.close()
+        self.transport.write(self.conn.data_to_send())
+
+
+class H2Server(Server):
+    """ HippoD stand-in speaking cleartext HTTP/2 only (h2c with prior
+    knowledge), responses are delayed by delay seconds.
+    """
+
+    def __init__(self, status=201, delay=0.0):
+        Server.__init__(self, status)
+        self.delay = delay
+        self.connections = 0
+        self.streams = 0
+        self.max_streams = 0
+
+    def _run(self):
+        asyncio.set_event_loop(self.loop)
+        coro = self.loop.create_server(lambda: H2Protocol(self), "127.0.0.1", 0)
+        self.server = self.loop.run_until_complete(coro)
+        self.port = self.server.sockets[0].getsockname()[1]
+        self.ready.set()
+        self.loop.run_forever()
+
+    def stop(self):
+        self.server.close()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
@@ -0,0 +1,233 @@
+import os
+import json
+import zlib
+import base64
+import struct
+import shutil
+import tempfile
+
+from unittest import TestCase
+
+import hippodclient
+from hippodclient import attachments
+from hippodclient.attachments import AttachmentPolicy, png_optimize, PNG_SIGNATURE
+from hippodclient.transport import MemoryTransport
+from hippodclient.tests.server import Server
+from hippodclient.tests.helpers import data_path, gen_test
+
+
+def png_pixels(data):
+    offset = len(PNG_SIGNATURE)
+    idat = list()
+    while offset < len(data):
+        length, = struct.unpack(">I", data[offset:offset + 4])
+        if data[offset + 4:offset + 8] == b"IDAT":
+            idat.append(data[offset + 8:offset + 8 + length])
+        offset += 12 + length
+    return zlib.decompress(b"".join(idat))
+
+
+def entries(t, policy=None):
+    doc = json.loads(t.json(policy))
+    data = doc["object-item"].get("data", []) + doc["achievements"][0].get("data", [])
+    return [(e["name"], e["mime-type"], base64.b64decode(e["data"])) for e in data]
+
+
+class TestAttachmentPolicy(TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_no_policy(self):
+        t = gen_test("Attachment Unmodified", "attachments")
+        t.data_file_add(data_path("graph.png"))
+        t.achievement.data_file_add(data_path("hippod.log"))
+        (_, mime_png, png), (_, mime_log, log) = entries(t)
+        self.assertEqual(mime_png, "image/png")
+        with open(data_path("graph.png"), "rb") as f:
+            self.assertEqual(png, f.read())
+        with open(data_path("hippod.log"), "rb") as f:
+            self.assertEqual(log, f.read())
+
+    def test_head_tail(self):
+        policy = AttachmentPolicy(max_entry_size=4096)
+        t = gen_test("Attachment Head Tail", "attachments")
+        t.data_file_add(data_path("hippod.log"))
+        (_, mime_type, data), = entries(t, policy)
+        with open(data_path("hippod.log"), "rb") as f:
+            log = f.read()
+        self.assertEqual(mime_type, "text/plain")
+        self.assertLessEqual(len(data), 4096)
+        self.assertTrue(log.startswith(data[:1000]))
+        self.assertTrue(log.endswith(data[-1000:]))
+        self.assertIn(b"bytes trimmed by hippodclient", data)
+        self.assertEqual(policy.report[0]["action"], "head-tail")
+        self.assertEqual(policy.report[0]["size"], len(log))
+
+    def test_head_tail_tiny_limit(self):
+        # not even the trim marker fits
+        policy = AttachmentPolicy(max_entry_size=10)
+        t = gen_test("Attachment Tiny Limit", "attachments")
+        t.data_file_add(data_path("hippod.log"))
+        (_, mime_type, data), = entries(t, policy)
+        self.assertIn(b"omitted", data)
+        self.assertEqual(policy.report[0]["action"], "omitted")
+
+    def test_read_on_add(self):
+        path = os.path.join(self.tmpdir, "out.log")
+        with open(path, "wb") as f:
+            f.write(b"first\n")
+        t = gen_test("Attachment Read On Add", "attachments")
+        t.data_file_add(path)
+        lazy = gen_test("Attachment Read On Upload", "attachments")
+        lazy.data_file_add(path, lazy=True)
+        with open(path, "wb") as f:
+            f.write(b"second\n")
+        self.assertEqual(entries(t)[0][2], b"first\n")
+        self.assertEqual(entries(lazy)[0][2], b"second\n")
+        lazy = gen_test("Attachment Removed", "attachments")
+        lazy.data_file_add(path, lazy=True)
+        os.unlink(path)
+        self.assertEqual(entries(t)[0][2], b"first\n")
+        with self.assertRaises(hippodclient.hippodclient.ArgumentException):
+            lazy.json()
+
+    def test_test_budget(self):
+        policy = AttachmentPolicy(max_test_size=6000)
+        t = gen_test("Attachment Test Budget", "attachments")
+        t.data_file_add(data_path("hippod.log"))
+        t.achievement.data_file_add(data_path("hippod.log"))
+        sizes = [len(data) for _, _, data in entries(t, policy)]
+        self.assertLessEqual(sum(sizes), 6000)
+        self.assertEqual(len(policy.report), 2)
+
+    def test_pcap_slice(self):
+        path = os.path.join(self.tmpdir, "capture.pcap")
+        header = struct.pack("<IHHiIII", 0xa1b2c3d4, 2, 4, 0, 0, 65535, 1)
+        packet = struct.pack("<IIII", 0, 0, 100, 100) + b"p" * 100
+        with open(path, "wb") as f:
+            f.write(header + packet * 10)
+        policy = AttachmentPolicy(max_entry_size=300)
+        t = gen_test("Attachment Pcap Slice", "attachments")
+        t.data_file_add(path)
+        (_, mime_type, data), = entries(t, policy)
+        self.assertEqual(mime_type, "application/vnd.tcpdump.pcap")
+        self.assertEqual(data, header + packet * 2)
+        self.assertEqual(policy.report[0]["action"], "pcap-slice")
+        # not even the global header fits
+        policy = AttachmentPolicy(max_entry_size=10)
+        (_, mime_type, data), = entries(t, policy)
+        self.assertEqual(mime_type, "text/plain")
+        self.assertIn(b"omitted", data)
+        self.assertEqual(policy.report[0]["action"], "omitted")
+
+    def test_omitted(self):
+        path = os.path.join(self.tmpdir, "core.bin")
+        with open(path, "wb") as f:
+            f.write(os.urandom(2000))
+        policy = AttachmentPolicy(max_entry_size=1000)
+        t = gen_test("Attachment Omitted", "attachments")
+        t.achievement.data_file_add(path)
+        (name, mime_type, data), = entries(t, policy)
+        self.assertEqual(name, "core.bin")
+        self.assertEqual(mime_type, "text/plain")
+        self.assertIn(b"omitted", data)
+        self.assertEqual(policy.report[0]["action"], "omitted")
+        self.assertEqual(policy.report[0]["size"], 2000)
+        self.assertEqual(policy.report[0]["new-size"], len(data))
+
+    def test_png_optimize(self):
+        with open(data_path("graph.png"), "rb") as f:
+            png = f.read()
+        optimized = png_optimize(png)
+        self.assertLessEqual(len(optimized), len(png))
+        self.assertEqual(png_pixels(optimized), png_pixels(png))
+
+    def test_container(self):
+        transport = MemoryTransport()
+        policy = AttachmentPolicy(max_entry_size=2048)
+        c = hippodclient.Container(url="http://hippod", transport=transport,
+                                   attachment_policy=policy)
+        t = gen_test("Attachment Container", "attachments")
+        t.data_file_add(data_path("hippod.log"))
+        c.add(t)
+        c.sync()
+        _, data, _ = transport.requests[0]
+        self.assertLess(len(data), 2048 * 2)
+        self.assertEqual(len(policy.report), 1)
+
+
+class TestDeferredEncoding(TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.chunk = attachments.ENCODE_CHUNK
+
+    def tearDown(self):
+        attachments.ENCODE_CHUNK = self.chunk
+        shutil.rmtree(self.tmpdir)
+
+    def random_file(self, name, size):
+        path = os.path.join(self.tmpdir, name)
+        with open(path, "wb") as f:
+            f.write(os.urandom(size))
+        return path
+
+    def test_body_equals_json(self):
+        # sizes around the chunk size, padded and unpadded encodings
+        attachments.ENCODE_CHUNK = 3 * 1024
+        t = gen_test("Deferred Body", "attachments")
+        t.data_file_add(self.random_file("a.bin", 100000), lazy=True)
+        t.achievement.data_file_add(self.random_file("b.bin", 99999))
+        t.achievement.data_file_add(data_path("hippod.log"))
+        other = gen_test("Deferred Body", "attachments")
+        other.achievement.data_file_add(self.random_file("c.bin", 3 * 1024 * 40 + 1))
+        body = t.body(coalesced=[other])
+        self.assertIsInstance(body, bytearray)
+        self.assertEqual(bytes(body), t.json(coalesced=[other]).encode())
+        # cached object-item fragment with placeholder
+        self.assertEqual(bytes(t.body()), t.json().encode())
+        clone = t.clone()
+        self.assertEqual(bytes(clone.body()), clone.json().encode())
+
+    def test_body_policy(self):
+        t = gen_test("Deferred Policy", "attachments")
+        t.data_file_add(self.random_file("a.bin", 100000))
+        t.achievement.data_file_add(self.random_file("b.bin", 100000))
+        for policy in (AttachmentPolicy(max_entry_size=200000),
+                       AttachmentPolicy(max_test_size=150000)):
+            self.assertEqual(bytes(t.body(policy)), t.json(policy).encode())
+        _, _, data = entries(t, AttachmentPolicy(max_test_size=150000))[1]
+        self.assertIn(b"omitted", data)
+
+    def test_file_changed(self):
+        path = self.random_file("a.bin", 100000)
+        t = gen_test("Deferred Changed", "attachments")
+        t.data_file_add(path, lazy=True)
+        data, blobs = t._serialize(None, (), True)
+        with open(path, "ab") as f:
+            f.write(b"more")
+        with self.assertRaises(hippodclient.hippodclient.ArgumentException):
+            attachments.assemble(data, blobs)
+
+    def test_upload(self):
+        path = self.random_file("a.bin", 300000)
+        with open(path, "rb") as f:
+            content = f.read()
+        server = Server()
+        url = server.start()
+        try:
+            for transport in ("aiohttp", "http2"):
+                c = hippodclient.Container(url=url, transport=transport)
+                t = gen_test("Deferred Upload", "attachments")
+                t.data_file_add(path)
+                c.add(t)
+                self.assertEqual(c.sync(), [(True, None)])
+            for doc in server.received:
+                entry, = doc["object-item"]["data"]
+                self.assertEqual(base64.b64decode(entry["data"]), content)
+        finally:
+            server.stop()
@@ -0,0 +1,166 @@
+import os
+import json
+import gzip
+import shutil
+import tempfile
+
+from unittest import TestCase, mock
+
+import hippodclient
+from hippodclient import bundle
+from hippodclient.__main__ import main
+from hippodclient.tests.server import Server
+from hippodclient.tests.helpers import gen_test, image_path
+
+
+def gen_bundle_test(title, result="passed"):
+    t = gen_test(title, "bundle", result, date="2016-01-01T00:00:00")
+    t.data_file_add(image_path())
+    t.achievement.data_file_add(image_path())
+    return t
+
+
+class TestBundle(TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, "results.ndjson.gz")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_export_roundtrip(self):
+        c = hippodclient.Container()
+        tests = [gen_bundle_test("Bundle Roundtrip {}".format(i)) for i in range(3)]
+        for t in tests:
+            c.add(t)
+        ids = c.export(self.path)
+        self.assertEqual(len(ids), 3)
+        replayed = dict(bundle.BundleReader(self.path).tests())
+        for record_id, t in zip(ids, tests):
+            self.assertEqual(json.loads(replayed[record_id]), json.loads(t.json()))
+
+    def test_attachments_stored_once(self):
+        c = hippodclient.Container()
+        for i in range(5):
+            c.add(gen_bundle_test("Bundle Dedup {}".format(i)))
+        c.export(self.path)
+        # a second export appends, known blobs are not written again
+        c.export(self.path)
+        with gzip.open(self.path, "rb") as fd:
+            records = [json.loads(line.decode()) for line in fd]
+        blobs = [r for r in records if r["type"] == "blob"]
+        tests = [r for r in records if r["type"] == "test"]
+        self.assertEqual(len(tests), 10)
+        self.assertEqual(len(blobs), len(set(r["id"] for r in blobs)))
+        self.assertEqual(len([r for r in records if r["type"] == "header"]), 1)
+
+    def test_sharding(self):
+        c = hippodclient.Container()
+        tests = [gen_bundle_test("Bundle Shard {}".format(i)) for i in range(7)]
+        for t in tests:
+            c.add(t)
+        # one member per test, the image blobs are stored in the first
+        with mock.patch.object(bundle, "MEMBER_SIZE", 1):
+            ids = c.export(self.path)
+        reader = bundle.BundleReader(self.path)
+        self.assertEqual(len(bundle.index_read(self.path)[1]), 7)
+        shards = [dict(reader.tests(shard, 3)) for shard in range(3)]
+        self.assertEqual([len(shard) for shard in shards], [3, 2, 2])
+        replayed = dict()
+        for shard in shards:
+            replayed.update(shard)
+        for record_id, t in zip(ids, tests):
+            self.assertEqual(json.loads(replayed[record_id]), json.loads(t.json()))
+
+    def test_blob_index(self):
+        c = hippodclient.Container()
+        c.add(gen_bundle_test("Bundle Index"))
+        c.export(self.path)
+        blobs = bundle.BundleReader(self.path).blob_ids()
+        self.assertEqual(bundle.index_load(self.path), blobs)
+        # a valid index spares reading the bundle
+        with mock.patch.object(bundle.BundleReader, "_scan") as scan:
+            c.export(self.path)
+            scan.assert_not_called()
+        # a stale or missing index is rebuilt
+        os.unlink(bundle.index_path(self.path))
+        c.export(self.path)
+        self.assertEqual(bundle.index_load(self.path), blobs)
+        with open(bundle.index_path(self.path), "a") as fd:
+            fd.write("0" * 40 + "\n")
+            fd.write("size 1\n")
+        self.assertEqual(bundle.index_load(self.path), blobs)
+        with gzip.open(self.path, "rb") as fd:
+            records = [json.loads(line.decode()) for line in fd]
+        self.assertEqual(len([r for r in records if r["type"] == "blob"]), len(blobs))
+        # an index without member offsets is rebuilt
+        with open(bundle.index_path(self.path), "w") as fd:
+            fd.write("".join(blob_id + "\n" for blob_id in blobs))
+            fd.write("size {}\n".format(os.path.getsize(self.path)))
+        index, members = bundle.index_read(self.path)
+        self.assertEqual(set(index), blobs)
+        self.assertEqual(members[0], 0)
+
+    def test_shard_blobs(self):
+        # every test with its own attachment, a shard decodes only its own
+        c = hippodclient.Container()
+        for i in range(6):
+            path = os.path.join(self.tmpdir, "attachment-{}.txt".format(i))
+            with open(path, "w") as fd:
+                fd.write("attachment {}\n".format(i))
+            t = gen_test("Bundle Shard Blobs {}".format(i), "bundle")
+            t.data_file_add(path)
+            c.add(t)
+        with mock.patch.object(bundle, "MEMBER_SIZE", 1):
+            c.export(self.path)
+        bundle.index_read(self.path)
+        reader = bundle.BundleReader(self.path)
+        with mock.patch.object(bundle, "_blob_data", wraps=bundle._blob_data) as decode, \
+             mock.patch.object(bundle, "_member_lines", wraps=bundle._member_lines) as members:
+            tests = list(reader.tests(0, 3))
+        self.assertEqual(len(tests), 2)
+        self.assertEqual(decode.call_count, 2)
+        # only the two own members are decompressed
+        self.assertEqual(members.call_count, 2)
+        names = [json.loads(data)["object-item"]["data"][0]["name"] for _, data in tests]
+        self.assertEqual(names, ["attachment-0.txt", "attachment-3.txt"])
+
+    def test_replay_resume(self):
+        server = Server()
+        url = server.start()
+        try:
+            c = hippodclient.Container()
+            for i in range(6):
+                c.add(gen_bundle_test("Bundle Replay {}".format(i)))
+            ids = c.export(self.path)
+            argv = ["replay", "--url", url, "-j", "2", self.path]
+            self.assertEqual(main(argv), 0)
+            self.assertEqual(len(server.received), 6)
+            self.assertEqual(bundle.journal_load(self.path), set(ids))
+            # everything is journaled, a second run uploads nothing
+            self.assertEqual(main(argv), 0)
+            self.assertEqual(len(server.received), 6)
+        finally:
+            server.stop()
+
+    def test_replay_corrupt(self):
+        c = hippodclient.Container()
+        for i in range(4):
+            c.add(gen_bundle_test("Bundle Corrupt {}".format(i)))
+        with mock.patch.object(bundle, "MEMBER_SIZE", 1):
+            c.export(self.path)
+        argv = ["replay", "--url", "http://127.0.0.1:9/", "-j", "2", self.path]
+        # damage the last member, the index still matches: a worker fails
+        offset = bundle.index_read(self.path)[1][-1]
+        with open(self.path, "r+b") as fd:
+            fd.seek(offset + 20)
+            fd.write(b"\xff" * 8)
+        with mock.patch("sys.stderr") as stderr:
+            self.assertEqual(main(argv), 1)
+        self.assertIn("replay: Bundle", "".join(str(call) for call in stderr.write.call_args_list))
+        # a truncated bundle fails while indexing
+        with open(self.path, "r+b") as fd:
+            fd.truncate(offset + 10)
+        with mock.patch("sys.stderr"):
+            self.assertEqual(main(argv), 1)
@@ -0,0 +1,96 @@
+import os
+import json
+import shutil
+import tempfile
+
+from unittest import TestCase
+
+import hippodclient
+from hippodclient.transport import MemoryTransport
+from hippodclient.tests.helpers import gen_test, image_path
+
+
+def gen_param_test(title, result, category="coalesce"):
+    t = gen_test(title, category, result)
+    t.description_plain_set("Parametrized test")
+    t.data_file_add(image_path())
+    return t
+
+
+class TitleStatusTransport(MemoryTransport):
+    """ Answers tests with the title "Broken" with HTTP 500 """
+
+    async def post(self, url, data, headers):
+        await MemoryTransport.post(self, url, data, headers)
+        if json.loads(data.decode())["object-item"]["title"] == "Broken":
+            return 500
+        return self.status
+
+
+def documents(transport):
+    return [json.loads(data.decode()) for _, data, _ in transport.requests]
+
+
+class TestCoalesce(TestCase):
+
+    def test_same_object(self):
+        transport = MemoryTransport()
+        c = hippodclient.Container(url="http://hippod", transport=transport)
+        results = ["passed", "failed"] * 250
+        for result in results:
+            c.add(gen_param_test("Parametrized", result))
+        ret = c.sync()
+        self.assertEqual(len(ret), 500)
+        doc, = documents(transport)
+        self.assertEqual([a["result"] for a in doc["achievements"]], results)
+        self.assertEqual(len(doc["object-item"]["data"]), 2)
+
+    def test_different_objects(self):
+        transport = MemoryTransport()
+        c = hippodclient.Container(url="http://hippod", transport=transport)
+        c.add(gen_param_test("First", "passed"))
+        c.add(gen_param_test("Second", "passed"))
+        c.add(gen_param_test("First", "failed", category="other"))
+        t = gen_param_test("First", "failed")
+        t.attachment.tags_set("flaky")
+        c.add(t)
+        c.add(gen_param_test("First", "exception"))
+        self.assertEqual(len(c.sync()), 5)
+        docs = documents(transport)
+        self.assertEqual(len(docs), 4)
+        self.assertEqual([len(d["achievements"]) for d in docs], [2, 1, 1, 1])
+        self.assertEqual([a["result"] for a in docs[0]["achievements"]], ["passed", "exception"])
+
+    def test_disabled(self):
+        transport = MemoryTransport()
+        c = hippodclient.Container(url="http://hippod", transport=transport, coalesce=False)
+        for i in range(3):
+            c.add(gen_param_test("Parametrized", "passed"))
+        c.sync()
+        self.assertEqual(len(transport.requests), 3)
+
+    def test_result_order(self):
+        transport = TitleStatusTransport()
+        c = hippodclient.Container(url="http://hippod", transport=transport)
+        c.add(gen_param_test("First", "passed"))
+        c.add(gen_param_test("Broken", "passed"))
+        c.add(gen_param_test("First", "failed"))
+        c.add(gen_param_test("Second", "passed"))
+        c.add(gen_param_test("Broken", "failed"))
+        failed = (False, "HTTP status 500")
+        self.assertEqual(c.sync(), [(True, None), failed, (True, None), (True, None), failed])
+        self.assertEqual(len(transport.requests), 3)
+
+    def test_export_order(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            c = hippodclient.Container()
+            for title in ("First", "Second", "First", "Third", "Second"):
+                c.add(gen_param_test(title, "passed"))
+            ids = c.export(os.path.join(tmpdir, "bundle.ndjson.gz"))
+            self.assertEqual(len(set(ids)), 3)
+            self.assertEqual(ids[0], ids[2])
+            self.assertEqual(ids[1], ids[4])
+            self.assertNotIn(ids[3], (ids[0], ids[1]))
+        finally:
+            shutil.rmtree(tmpdir)
@@ -0,0 +1,112 @@
+import socket
+from collections import Counter
+
+from unittest import TestCase
+
+import hippodclient
+from hippodclient.endpoints import EndpointPool
+from hippodclient.tests.server import Server
+from hippodclient.tests.helpers import gen_test
+
+
+def unused_url():
+    s = socket.socket()
+    s.bind(("127.0.0.1", 0))
+    port = s.getsockname()[1]
+    s.close()
+    return "http://127.0.0.1:{}/".format(port)
+
+
+class TestEndpointPool(TestCase):
+
+    def test_least_outstanding(self):
+        pool = EndpointPool(["http://a", "http://b"])
+        first = pool.acquire()
+        second = pool.acquire()
+        self.assertNotEqual(first, second)
+        pool.release(first, True)
+        self.assertEqual(pool.acquire(), first)
+
+    def test_weighted_round_robin(self):
+        pool = EndpointPool([("http://a", 3), ("http://b", 1)], strategy="round-robin")
+        counter = Counter()
+        for i in range(8):
+            endpoint = pool.acquire()
+            pool.release(endpoint, True)
+            counter[endpoint.url] += 1
+        self.assertEqual(counter, Counter({"http://a": 6, "http://b": 2}))
+
+    def test_circuit_breaker(self):
+        pool = EndpointPool(["http://a", "http://b"], strategy="round-robin",
+                            failure_threshold=2, reset_timeout=0.05)
+        a, b = pool.endpoints
+        for i in range(2):
+            pool.release(pool.acquire(exclude=[b]), False)
+        self.assertEqual(a.state, "open")
+        self.assertEqual(pool.acquire(), b)
+        pool.release(b, True)
+        # after reset timeout one probe is allowed
+        a.opened_at -= 1
+        self.assertEqual(pool.acquire(exclude=[b]), a)
+        self.assertEqual(a.state, "half-open")
+        # no other endpoint left: the ejected one is used anyway
+        self.assertEqual(pool.acquire(exclude=[b]), a)
+        self.assertEqual(pool.acquire(exclude=[a, b]), None)
+        pool.release(a, True)
+        pool.release(a, True)
+        self.assertEqual(a.state, "closed")
+        self.assertEqual(a.stats()["ejections"], 1)
+
+    def test_all_ejected(self):
+        pool = EndpointPool(["http://a", "http://b"], failure_threshold=1)
+        a, b = pool.endpoints
+        pool.release(pool.acquire(exclude=[b]), False)
+        pool.release(pool.acquire(exclude=[a]), False)
+        self.assertEqual((a.state, b.state), ("open", "open"))
+        b.opened_at -= 1
+        # the endpoint ejected longest ago is probed
+        self.assertEqual(pool.acquire(), b)
+        self.assertEqual(b.state, "half-open")
+
+
+class TestContainerEndpoints(TestCase):
+
+    def test_failover(self):
+        live, broken = Server(), Server(status=503)
+        urls = [unused_url(), broken.start(), live.start()]
+        try:
+            c = hippodclient.Container(url=urls, concurrency=2)
+            for i in range(10):
+                c.add(gen_test("Failover {}".format(i), "endpoints"))
+            ret = c.sync()
+            self.assertEqual(ret, [(True, None)] * 10)
+            self.assertEqual(len(live.received), 10)
+            stats = c.endpoint_stats()
+            self.assertEqual(stats[0]["state"], "open")
+            self.assertEqual(stats[1]["state"], "open")
+            self.assertEqual(stats[2]["failures"], 0)
+        finally:
+            live.stop()
+            broken.stop()
+
+    def test_single_flaky_endpoint(self):
+        # three 503 in a row eject the only server, the other tests still go out
+        server = Server(fail_first=3)
+        try:
+            c = hippodclient.Container(url=server.start(), concurrency=1)
+            for i in range(10):
+                c.add(gen_test("Flaky {}".format(i), "endpoints"))
+            ret = c.sync()
+            self.assertEqual(ret[:3], [(False, "HTTP status 503")] * 3)
+            self.assertEqual(ret[3:], [(True, None)] * 7)
+            self.assertEqual(len(server.received), 7)
+            self.assertEqual(c.endpoint_stats()[0]["state"], "closed")
+        finally:
+            server.stop()
+
+    def test_no_healthy_endpoint(self):
+        c = hippodclient.Container(url=[unused_url()])
+        c.add(gen_test("No Endpoint", "endpoints"))
+        ok, emsg = c.sync()[0]
+        self.assertFalse(ok)
+        self.assertTrue(emsg)
@@ -0,0 +1,140 @@
+import os
+import sys
+import json
+import shutil
+import tempfile
+import textwrap
+import subprocess
+
+from unittest import TestCase, skipUnless
+
+import hippodclient
+from hippodclient import bench, pytest_plugin
+from hippodclient.bundle import BundleReader
+from hippodclient.transport import MemoryTransport
+
+try:
+    import xdist
+    HAVE_XDIST = True
+except ImportError:
+    HAVE_XDIST = False
+
+
+SUITE = """
+import pytest
+
+def test_passed():
+    pass
+
+def test_failed():
+    assert 1 == 2
+
+@pytest.fixture
+def broken():
+    raise RuntimeError("setup")
+
+def test_setup_error(broken):
+    pass
+
+@pytest.mark.skip
+def test_skipped():
+    pass
+
+@pytest.mark.parametrize("n", [1, 2, 3])
+def test_param(n):
+    assert n != 3
+
+class TestGroup:
+    def test_method(self):
+        pass
+"""
+
+
+class CountingTransport(MemoryTransport):
+
+    def __init__(self):
+        MemoryTransport.__init__(self)
+        self.opened = 0
+
+    async def open(self, concurrency, timeout):
+        self.opened += 1
+
+
+class TestUploader(TestCase):
+
+    def test_one_session(self):
+        transport = CountingTransport()
+        c = hippodclient.Container(url="http://hippod", transport=transport)
+        c._check_pre_sync()
+        uploader = pytest_plugin.Uploader(c)
+        for i in range(600):
+            test = pytest_plugin.report_to_test("test_mod.py::test_{}[{}]".format(i % 3, i),
+                                                "passed", None, "pytest", "anonymous")
+            uploader.add(test)
+        uploader.close()
+        self.assertEqual(len(uploader.results), 600)
+        self.assertTrue(all(ok for ok, _ in uploader.results))
+        # one transport for the whole session, batches coalesced
+        self.assertEqual(transport.opened, 1)
+        self.assertLess(len(transport.requests), 600)
+
+
+class TestPytestPlugin(TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        with open(os.path.join(self.tmpdir, "test_suite.py"), "w") as fd:
+            fd.write(textwrap.dedent(SUITE))
+        self.env = dict(os.environ)
+        root = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+        self.env["PYTHONPATH"] = root
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _pytest(self, *args):
+        cmd = [sys.executable, "-m", "pytest", "-p", "no:cacheprovider"] + \
+              pytest_plugin.PLUGIN_ARGS + list(args)
+        proc = subprocess.run(cmd, cwd=self.tmpdir, env=self.env, universal_newlines=True,
+                              stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        return proc.stdout
+
+    def _export(self, *args):
+        path = os.path.join(self.tmpdir, "results.ndjson.gz")
+        self._pytest("--hippod-export", path, *args)
+        docs = [json.loads(d) for _, d in BundleReader(path).tests()]
+        results = dict()
+        for doc in docs:
+            self.assertEqual(doc["object-item"]["categories"], ["pytest", "test-suite"])
+            for achievement in doc["achievements"]:
+                key = doc["object-item"]["title"]
+                if "anchor" in achievement:
+                    key += "[{}]".format(achievement["anchor"])
+                results[key] = achievement["result"]
+        return docs, results
+
+    def test_export(self):
+        docs, results = self._export()
+        self.assertEqual(results, {"test_passed": "passed",
+                                   "test_failed": "failed",
+                                   "test_setup_error": "exception",
+                                   "test_skipped": "nonapplicable",
+                                   "test_param[1]": "passed",
+                                   "test_param[2]": "passed",
+                                   "test_param[3]": "failed",
+                                   "TestGroup.test_method": "passed"})
+        # parametrized runs are one object
+        self.assertEqual(len(docs), 6)
+
+    @skipUnless(HAVE_XDIST, "pytest-xdist not installed")
+    def test_xdist(self):
+        docs, results = self._export("-n", "2")
+        self.assertEqual(len(results), 8)
+
+    def test_upload(self):
+        out = self._pytest("--hippod-url", "http://hippod", "--hippod-transport", "memory")
+        self.assertIn("hippod: 8 tests uploaded, 0 failed", out)
+
+    def test_bench(self):
+        results = bench.bench_pytest(count=20, modules=2)
+        self.assertEqual(results[1]["tests"], 20)
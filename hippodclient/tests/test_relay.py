@@ -0,0 +1,184 @@
+import os
+import time
+import zlib
+import socket
+import struct
+import shutil
+import asyncio
+import tempfile
+import threading
+
+from unittest import TestCase
+
+import hippodclient
+from hippodclient.hippodclient import ConfigurationException
+from hippodclient.bundle import BundleReader
+from hippodclient.relay import Relay, read_frame
+from hippodclient.transport import RelayTransport
+from hippodclient.tests.server import Server
+from hippodclient.tests.helpers import gen_test
+
+
+class RelayThread(object):
+
+    def __init__(self, url, path, **kwargs):
+        self.loop = asyncio.new_event_loop()
+        self.relay = Relay(url, path=path, **kwargs)
+        self.relay.container._loop = self.loop
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+
+    def start(self):
+        self.thread.start()
+        asyncio.run_coroutine_threadsafe(self.relay.start(), self.loop).result()
+
+    def stop(self):
+        asyncio.run_coroutine_threadsafe(self.relay.stop(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+
+
+class FakeRelay(object):
+    """ Reads one frame and answers with reply, then closes """
+
+    def __init__(self, path, reply):
+        self.path = path
+        self.reply = reply
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+
+    async def _handle(self, reader, writer):
+        await read_frame(reader)
+        writer.write(self.reply)
+        await writer.drain()
+        writer.close()
+
+    def start(self):
+        self.thread.start()
+        coro = asyncio.start_unix_server(self._handle, path=self.path)
+        self.server = asyncio.run_coroutine_threadsafe(coro, self.loop).result()
+
+    def stop(self):
+        self.loop.call_soon_threadsafe(self.server.close)
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+
+
+class TestRelay(TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, "relay.sock")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_forward(self):
+        server = Server()
+        relay = RelayThread(server.start(), self.path)
+        relay.start()
+        try:
+            for job in range(3):
+                transport = RelayTransport(self.path)
+                c = hippodclient.Container(transport=transport, concurrency=64)
+                for i in range(20):
+                    c.add(gen_test("Relay {} {}".format(job, i), "relay"))
+                self.assertEqual(c.sync(), [(True, None)] * 20)
+        finally:
+            relay.stop()
+            server.stop()
+        self.assertEqual(len(server.received), 60)
+        stats = relay.relay.stats
+        self.assertEqual(stats["connections"], 3)
+        self.assertEqual(stats["forwarded"], 60)
+        # tests of one sync are batched into few frames
+        self.assertLess(stats["frames"], 60)
+
+    def test_queue_full(self):
+        # unreachable upstream, the queue fills up
+        spool = os.path.join(self.tmpdir, "spool.ndjson.gz")
+        relay = RelayThread("http://127.0.0.1:9/", self.path, queue_size=5,
+                            spool=spool, retry_delay=0.01)
+        relay.start()
+        try:
+            c = hippodclient.Container(transport=RelayTransport(self.path), concurrency=64)
+            for i in range(20):
+                c.add(gen_test("Relay Full {}".format(i), "relay"))
+            ret = c.sync()
+            self.assertTrue(any(ok for ok, _ in ret))
+            self.assertFalse(all(ok for ok, _ in ret))
+            self.assertEqual(set(e for ok, e in ret if not ok), {"HTTP status 503"})
+            # backpressure is no server failure, the next sync reaches the relay
+            c.tests = [gen_test("Relay Full Again", "relay")]
+            again, = c.sync()
+            self.assertNotEqual(again[1], "no healthy hippod server available")
+        finally:
+            relay.stop()
+        # every acknowledged test ends up in the spool
+        accepted = len([ok for ok, _ in ret + [again] if ok])
+        self.assertEqual(len(list(BundleReader(spool).tests())), accepted)
+        self.assertEqual(relay.relay.stats["spooled"], accepted)
+
+    def test_retry(self):
+        server = Server(fail_first=2)
+        spool = os.path.join(self.tmpdir, "spool.ndjson.gz")
+        relay = RelayThread(server.start(), self.path, spool=spool, retry_delay=0.01)
+        relay.start()
+        try:
+            c = hippodclient.Container(transport=RelayTransport(self.path))
+            for i in range(2):
+                c.add(gen_test("Relay Retry {}".format(i), "relay"))
+            self.assertEqual(c.sync(), [(True, None)] * 2)
+            deadline = time.time() + 10
+            while relay.relay.stats["forwarded"] < 2 and time.time() < deadline:
+                time.sleep(0.01)
+        finally:
+            relay.stop()
+            server.stop()
+        self.assertEqual(len(server.received), 2)
+        self.assertEqual(relay.relay.stats["retried"], 2)
+        self.assertFalse(os.path.exists(spool))
+
+    def test_not_running(self):
+        c = hippodclient.Container(transport=RelayTransport(self.path))
+        c.add(gen_test("Relay Missing", "relay"))
+        with self.assertRaises(ConfigurationException):
+            c.sync()
+
+    def test_broken_reply(self):
+        # truncated frame, no zlib data, no json: posts fail, never hang
+        replies = [struct.pack(">I", 100) + b"x" * 10,
+                   struct.pack(">I", 3) + b"xyz",
+                   struct.pack(">I", 12) + zlib.compress(b"no json")[:12]]
+        for reply in replies:
+            relay = FakeRelay(self.path, reply)
+            relay.start()
+            try:
+                c = hippodclient.Container(transport=RelayTransport(self.path))
+                for i in range(3):
+                    c.add(gen_test("Relay Broken {}".format(i), "relay"))
+                ret = []
+                worker = threading.Thread(target=lambda: ret.extend(c.sync()), daemon=True)
+                worker.start()
+                worker.join(10)
+                self.assertFalse(worker.is_alive())
+                self.assertEqual(len(ret), 3)
+                self.assertFalse(any(ok for ok, _ in ret))
+            finally:
+                relay.stop()
+                os.unlink(self.path)
+
+    def test_garbage_frame(self):
+        relay = RelayThread("http://127.0.0.1:9/", self.path)
+        relay.start()
+        try:
+            s = socket.socket(socket.AF_UNIX)
+            s.connect(self.path)
+            s.sendall(struct.pack(">I", 3) + b"xyz")
+            # the relay drops the client and keeps serving
+            self.assertEqual(s.recv(16), b"")
+            s.close()
+            c = hippodclient.Container(transport=RelayTransport(self.path))
+            c.add(gen_test("Relay After Garbage", "relay"))
+            self.assertEqual(c.sync(), [(True, None)])
+        finally:
+            relay.stop()
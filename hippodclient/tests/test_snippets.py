@@ -0,0 +1,148 @@
+import os
+import base64
+import shutil
+import tempfile
+import textwrap
+
+from unittest import TestCase, skipUnless
+
+import hippodclient
+from hippodclient.hippodclient import TransformException
+from hippodclient.snippets import SnippetRenderer
+from hippodclient.transport import MemoryTransport
+from hippodclient.tests import test_hippodclient
+
+try:
+    import matplotlib
+    import numpy
+    HAVE_MATPLOTLIB = True
+except ImportError:
+    HAVE_MATPLOTLIB = False
+
+
+PNG_MAGIC = b"\x89PNG\r\n\x1a\n"
+
+
+def gen_script(directory, name, size):
+    # snippet without matplotlib, writes size bytes as "PNG"
+    path = os.path.join(directory, name)
+    content = """
+    import sys
+    with open(sys.argv[1], "wb") as f:
+        f.write(b"{}" * {})
+    """.format(name[0], size)
+    with open(path, "w") as fd:
+        fd.write(textwrap.dedent(content))
+    return path
+
+
+class TestSnippetRenderer(TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.cache_dir = os.path.join(self.tmpdir, "cache")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_cache(self):
+        renderer = SnippetRenderer(cache_dir=self.cache_dir, processes=2)
+        scripts = [gen_script(self.tmpdir, "{}.py".format(c), 100) for c in "abc"]
+        first = renderer.render(scripts)
+        self.assertEqual(renderer.misses, 3)
+        second = renderer.render(scripts)
+        self.assertEqual(first, second)
+        self.assertEqual(renderer.hits, 3)
+        with open(first[1], "rb") as f:
+            self.assertEqual(f.read(), b"b" * 100)
+
+    def test_eviction(self):
+        renderer = SnippetRenderer(cache_dir=self.cache_dir, max_cache_bytes=250)
+        old = renderer.render([gen_script(self.tmpdir, "a.py", 100)])[0]
+        os.utime(old, (0, 0))
+        new = renderer.render([gen_script(self.tmpdir, "b.py", 100),
+                               gen_script(self.tmpdir, "c.py", 100)])
+        self.assertFalse(os.path.exists(old))
+        for path in new:
+            self.assertTrue(os.path.exists(path))
+
+    def test_failure(self):
+        path = os.path.join(self.tmpdir, "broken.py")
+        with open(path, "w") as fd:
+            fd.write("raise RuntimeError('broken')\n")
+        renderer = SnippetRenderer(cache_dir=self.cache_dir)
+        with self.assertRaises(TransformException):
+            renderer.render([path])
+
+    def test_sys_exit(self):
+        ok = gen_script(self.tmpdir, "ok.py", 10)
+        with open(ok, "a") as fd:
+            fd.write("sys.exit(0)\n")
+        renderer = SnippetRenderer(cache_dir=self.cache_dir)
+        path, = renderer.render([ok])
+        with open(path, "rb") as f:
+            self.assertEqual(f.read(), b"o" * 10)
+        failed = gen_script(self.tmpdir, "failed.py", 10)
+        with open(failed, "a") as fd:
+            fd.write("sys.exit(2)\n")
+        with self.assertRaises(TransformException):
+            renderer.render([failed])
+
+    def test_worker_died(self):
+        path = os.path.join(self.tmpdir, "died.py")
+        with open(path, "w") as fd:
+            fd.write("import os\nos._exit(3)\n")
+        renderer = SnippetRenderer(cache_dir=self.cache_dir)
+        with self.assertRaises(TransformException):
+            renderer.render([path, gen_script(self.tmpdir, "ok.py", 10)])
+        self.assertEqual([n for n in os.listdir(self.cache_dir) if n.endswith(".tmp.png")], [])
+
+    def test_template_not_modified(self):
+        renderer = SnippetRenderer(cache_dir=self.cache_dir)
+        c = hippodclient.Container(url="http://hippod", transport=MemoryTransport(),
+                                   snippet_renderer=renderer)
+        template = hippodclient.Test()
+        template.categories_set("team:foo", "snippets")
+        template.snippet_file_add(gen_script(self.tmpdir, "a.py", 10),
+                                  "x-snippet-python3-matplot-png", render=True)
+        data = template.data
+        clones = list()
+        for i in range(2):
+            t = template.clone()
+            t.title_set("Rendered Clone {}".format(i))
+            c.add(t)
+            clones.append(t)
+        self.assertEqual(c.sync(), [(True, None)] * 2)
+        # the template keeps its pending snippet, the clones still share one list
+        self.assertIs(template.data, data)
+        self.assertFalse(isinstance(data[0], dict))
+        self.assertIs(clones[0].data, clones[1].data)
+        self.assertEqual(base64.b64decode(clones[0].data[0]["data"]), b"a" * 10)
+
+    @skipUnless(HAVE_MATPLOTLIB, "matplotlib and numpy not installed")
+    def test_container(self):
+        transport = MemoryTransport()
+        renderer = SnippetRenderer(cache_dir=self.cache_dir)
+        c = hippodclient.Container(url="http://hippod", transport=transport,
+                                   snippet_renderer=renderer)
+        t = hippodclient.Test()
+        t.title_set("Rendered Snippet")
+        t.categories_set("team:foo", "snippets")
+        tmps = list()
+        for i in range(3):
+            tmp_dir, graph_path = test_hippodclient.gen_snippet_file(i)
+            t.snippet_file_add(graph_path, "x-snippet-python3-matplot-png", render=True)
+            t.achievement.snippet_file_add(graph_path, "x-snippet-python3-matplot-png",
+                                           name="graph.png", render=True)
+            tmps.append(tmp_dir)
+        c.add(t)
+        self.assertEqual(c.sync(), [(True, None)])
+        # the achievement snippets are identical, rendered once
+        self.assertEqual(renderer.misses, 3)
+        self.assertEqual(renderer.hits, 3)
+        for entry in t.data + t.achievement.data:
+            self.assertEqual(entry["mime-type"], "image/png")
+            self.assertTrue(base64.b64decode(entry["data"]).startswith(PNG_MAGIC))
+        self.assertEqual(t.achievement.data[0]["name"], "graph.png")
+        for tmp_dir in tmps:
+            shutil.rmtree(tmp_dir)
@@ -0,0 +1,26 @@
+from unittest import TestCase
+
+from hippodclient import bench
+
+
+# modules which must not be imported by just building tests
+LAZY_MODULES = ("asyncio", "aiohttp", "httpx", "pprint", "mimetypes", "getpass",
+                "textwrap", "multiprocessing")
+
+# generous, baseline with eager imports was ~35 ms
+IMPORT_BUDGET = 0.025
+
+
+class TestStartup(TestCase):
+
+    def test_lazy_imports(self):
+        modules = bench.bench_import()
+        self.assertIn("hippodclient", modules)
+        for name in LAZY_MODULES:
+            self.assertNotIn(name, modules)
+
+    def test_import_time(self):
+        # best of three against scheduling noise
+        cumulative = min(bench.bench_import("import hippodclient")["hippodclient"][1]
+                         for i in range(3))
+        self.assertLess(cumulative, IMPORT_BUDGET)
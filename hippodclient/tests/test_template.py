@@ -0,0 +1,99 @@
+import os
+import json
+import shutil
+import tempfile
+
+from unittest import TestCase
+
+from hippodclient.attachments import AttachmentPolicy
+from hippodclient.tests.helpers import gen_test, image_path
+
+
+def gen_template():
+    t = gen_test("Template", "template")
+    t.description_markdown_set("# Generated")
+    t.data_file_add(image_path())
+    t.attachment.tags_set("generated", "kernel")
+    t.attachment.references_set("ref:1")
+    return t
+
+
+class TestTemplate(TestCase):
+
+    def test_clone_document(self):
+        template = gen_template()
+        t = template.clone()
+        t.achievement.result_set("failed")
+        doc = json.loads(t.json())
+        expected = json.loads(template.json())
+        expected["achievements"][0]["result"] = "failed"
+        expected["achievements"][0]["test-date"] = doc["achievements"][0]["test-date"]
+        self.assertEqual(doc, expected)
+
+    def test_fragments_match_full_document(self):
+        t = gen_template()
+        data = t.json()
+        self.assertEqual(data, json.dumps(json.loads(data), sort_keys=True,
+                                          separators=(',', ': ')))
+
+    def test_copy_on_write(self):
+        template = gen_template()
+        first = template.clone()
+        second = template.clone()
+        first.attachment.tags_add("flaky")
+        first.description_plain_set("changed")
+        first.data_file_add(__file__)
+        second.title_set("Other Title")
+        template.attachment.references_add("ref:2")
+        self.assertEqual(template.attachment.tags, ["generated", "kernel"])
+        self.assertEqual(second.attachment.tags, ["generated", "kernel"])
+        self.assertEqual(first.attachment.references, ["ref:1"])
+        self.assertEqual(len(template.data), 2)
+        self.assertEqual(len(first.data), 3)
+        template_doc = json.loads(template.json())
+        first_doc = json.loads(first.json())
+        second_doc = json.loads(second.json())
+        self.assertEqual(template_doc["attachment"]["references"], ["ref:1", "ref:2"])
+        self.assertEqual(first_doc["attachment"]["tags"], ["generated", "kernel", "flaky"])
+        self.assertEqual(second_doc["object-item"]["title"], "Other Title")
+        self.assertEqual(template_doc["object-item"]["title"], "Template")
+        self.assertNotEqual(first_doc["object-item"]["data"], template_doc["object-item"]["data"])
+
+    def test_fragment_reuse(self):
+        template = gen_test("Template", "template")
+        template.description_markdown_set("# Generated")
+        template.json()
+        fragment = template._fragments["object-item"][4]
+        t = template.clone()
+        self.assertIs(t._object_item_json(None, None), fragment)
+        t.categories_set("team:bar")
+        self.assertIsNot(t._object_item_json(None, None), fragment)
+
+    def test_file_data_not_cached(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmpdir, "large.log")
+            with open(path, "wb") as f:
+                f.write(b"line\n" * 100000)
+            t = gen_test("Template Files", "template")
+            t.data_file_add(path, lazy=True)
+            t.json()
+            self.assertNotIn("object-item", t._fragments)
+            # deferred files are cached as placeholder only
+            t.body()
+            self.assertLess(len(t._fragments["object-item"][4]), 1000)
+            # the policy report lists the trimmed file on every serialization
+            policy = AttachmentPolicy(max_entry_size=4096)
+            t.json(policy)
+            t.json(policy)
+            self.assertEqual([r["action"] for r in policy.report], ["head-tail"] * 2)
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_description_after_file(self):
+        t = gen_template()
+        t.description_plain_set("replaced")
+        descriptions = [e for e in json.loads(t.json())["object-item"]["data"]
+                        if e.get("type") == "description"]
+        self.assertEqual(len(descriptions), 1)
+        self.assertEqual(descriptions[0]["mime-type"], "text/plain")
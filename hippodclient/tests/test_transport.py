@@ -0,0 +1,101 @@
+import os
+import json
+import shutil
+import tempfile
+
+from unittest import TestCase, skipUnless
+
+import hippodclient
+from hippodclient.hippodclient import ConfigurationException
+from hippodclient.transport import MemoryTransport
+from hippodclient.tests.server import Server, H2Server
+from hippodclient.tests.helpers import gen_test
+from hippodclient import bench
+
+try:
+    import httpx
+    import h2
+    HAVE_HTTPX = True
+except ImportError:
+    HAVE_HTTPX = False
+
+
+class TestTransport(TestCase):
+
+    def test_memory(self):
+        transport = MemoryTransport()
+        c = hippodclient.Container(url="http://hippod", transport=transport)
+        for i in range(3):
+            c.add(gen_test("Memory Transport {}".format(i), "transport"))
+        self.assertEqual(c.sync(), [(True, None)] * 3)
+        self.assertEqual(len(transport.requests), 3)
+        url, data, headers = transport.requests[0]
+        self.assertEqual(url, "http://hippod/api/v1/object")
+        self.assertEqual(headers["Content-type"], "application/json")
+        self.assertEqual(json.loads(data.decode())["object-item"]["categories"],
+                         ["team:foo", "transport"])
+
+    def test_unknown(self):
+        with self.assertRaises(ConfigurationException):
+            hippodclient.Container(url="http://hippod", transport="carrier-pigeon")
+
+    def _upload(self, transport):
+        server = Server()
+        url = server.start()
+        try:
+            c = hippodclient.Container(url=url, transport=transport)
+            for i in range(4):
+                c.add(gen_test("{} Transport {}".format(transport, i), "transport"))
+            self.assertEqual(c.sync(), [(True, None)] * 4)
+            self.assertEqual(len(server.received), 4)
+        finally:
+            server.stop()
+
+    def test_aiohttp(self):
+        self._upload("aiohttp")
+
+    @skipUnless(HAVE_HTTPX, "httpx and h2 not installed")
+    def test_http2(self):
+        # plain http test server, httpx falls back to HTTP/1.1
+        self._upload("http2")
+
+    @skipUnless(HAVE_HTTPX, "httpx and h2 not installed")
+    def test_h2c(self):
+        # HTTP/2 only server, all uploads multiplexed over one connection
+        server = H2Server(delay=0.05)
+        url = server.start()
+        try:
+            c = hippodclient.Container(url=url, transport="h2c", concurrency=8)
+            for i in range(16):
+                c.add(gen_test("h2c Transport {}".format(i), "transport"))
+            self.assertEqual(c.sync(), [(True, None)] * 16)
+        finally:
+            server.stop()
+        self.assertEqual(len(server.received), 16)
+        self.assertEqual(server.connections, 1)
+        self.assertGreater(server.max_streams, 1)
+
+    @skipUnless(HAVE_HTTPX, "httpx and h2 not installed")
+    def test_h2c_large_body(self):
+        # streamed body beyond the HTTP/2 flow control window
+        tmpdir = tempfile.mkdtemp()
+        server = H2Server()
+        url = server.start()
+        try:
+            path = os.path.join(tmpdir, "large.bin")
+            with open(path, "wb") as f:
+                f.write(os.urandom(3 << 20))
+            c = hippodclient.Container(url=url, transport="h2c")
+            t = gen_test("h2c Large Body", "transport")
+            t.data_file_add(path, lazy=True)
+            c.add(t)
+            self.assertEqual(c.sync(), [(True, None)])
+        finally:
+            server.stop()
+            shutil.rmtree(tmpdir)
+        self.assertEqual(server.received[0]["object-item"]["data"][0]["name"], "large.bin")
+
+    def test_bench(self):
+        results = bench.bench_transport("http://hippod", ["memory"], count=50)
+        self.assertEqual(results[0]["requests"], 50)
+        self.assertEqual(results[0]["failed"], 0)
@@ -0,0 +1,234 @@
+# -*- coding: utf-8 -*-
+
+from hippodclient.hippodclient import ConfigurationException, TransportException
+
+
+# bytes per write of request bodies streamed in pieces
+BODY_CHUNK = 1024 * 1024
+
+
+class Transport(object):
+    """ Base class of all transports used by Container
+
+    A transport is opened once per sync(), all uploads of this sync
+    share the transport and its connections. post() returns the HTTP
+    status code and raises TransportException if no response was
+    received at all.
+    """
+
+    name = None
+    # False: the transport knows the server itself, url is optional
+    requires_url = True
+
+    async def open(self, concurrency, timeout):
+        pass
+
+    async def post(self, url, data, headers):
+        raise NotImplementedError
+
+    async def close(self):
+        pass
+
+
+class AiohttpTransport(Transport):
+    """ HTTP/1.1 with a pool of up to concurrency keep-alive connections """
+
+    name = "aiohttp"
+
+    def __init__(self):
+        self.session = None
+
+    async def open(self, concurrency, timeout):
+        import aiohttp
+        connector = aiohttp.TCPConnector(limit=concurrency)
+        timeout = aiohttp.ClientTimeout(total=timeout)
+        self.session = aiohttp.ClientSession(connector=connector, timeout=timeout)
+
+    async def post(self, url, data, headers):
+        import asyncio
+        import aiohttp
+        try:
+            async with self.session.post(url, data=data, headers=headers) as resp:
+                await resp.read()
+                return resp.status
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            raise TransportException(str(e) or type(e).__name__)
+
+    async def close(self):
+        await self.session.close()
+        self.session = None
+
+
+class Http2Transport(Transport):
+    """ HTTP/2 via httpx, all uploads to one server are multiplexed
+    as concurrent streams over a single connection.
+
+    HTTP/2 is negotiated via TLS ALPN for https URLs. For plain http
+    servers speaking h2c set prior_knowledge=True.
+    """
+
+    name = "http2"
+
+    def __init__(self, prior_knowledge=False):
+        self.prior_knowledge = prior_knowledge
+        self.client = None
+
+    async def open(self, concurrency, timeout):
+        try:
+            import httpx
+            import h2
+        except ImportError:
+            emsg = "http2 transport requires httpx and h2: pip install httpx[http2]"
+            raise ConfigurationException(emsg)
+        limits = httpx.Limits(max_connections=concurrency)
+        self.client = httpx.AsyncClient(http1=not self.prior_knowledge, http2=True,
+                                        limits=limits, timeout=timeout)
+
+    async def _chunks(self, data):
+        # httpx takes bytes only, large bodies are streamed in pieces
+        # instead of copied as a whole
+        with memoryview(data) as view:
+            for start in range(0, len(view), BODY_CHUNK):
+                yield bytes(view[start:start + BODY_CHUNK])
+
+    async def post(self, url, data, headers):
+        import httpx
+        if not isinstance(data, bytes):
+            headers = dict(headers)
+            headers["Content-Length"] = str(len(data))
+            data = self._chunks(data)
+        try:
+            resp = await self.client.post(url, content=data, headers=headers)
+        except httpx.HTTPError as e:
+            raise TransportException(str(e) or type(e).__name__)
+        return resp.status_code
+
+    async def close(self):
+        await self.client.aclose()
+        self.client = None
+
+
+class H2cTransport(Http2Transport):
+    """ Cleartext HTTP/2 with prior knowledge (h2c), for plain http
+    servers speaking HTTP/2 only, e.g. behind a h2c capable proxy.
+    """
+
+    name = "h2c"
+
+    def __init__(self):
+        Http2Transport.__init__(self, prior_knowledge=True)
+
+
+class MemoryTransport(Transport):
+    """ No network at all, requests are recorded in self.requests
+
+    Useful for tests and to benchmark the client side alone.
+    """
+
+    name = "memory"
+
+    def __init__(self, status=201, record=True):
+        self.status = status
+        self.record = record
+        self.requests = list()
+
+    async def post(self, url, data, headers):
+        if self.record:
+            self.requests.append((url, data, headers))
+        return self.status
+
+
+class RelayTransport(Transport):
+    """ Hand tests to the host-local relay daemon over a Unix socket
+
+    Concurrent posts are collected for up to delay seconds (at most
+    batch_size) and sent as one compressed frame. A post returns once
+    the relay queued the test, the relay uploads it later. Use a high
+    Container concurrency to get large batches.
+    """
+
+    name = "relay"
+    requires_url = False
+
+    def __init__(self, path=None, batch_size=256, delay=0.002):
+        self.path = path
+        self.batch_size = batch_size
+        self.delay = delay
+        self.reader = None
+        self.writer = None
+
+    async def open(self, concurrency, timeout):
+        import asyncio
+        from hippodclient.relay import default_socket_path
+        path = self.path or default_socket_path()
+        try:
+            self.reader, self.writer = await asyncio.open_unix_connection(path)
+        except OSError as e:
+            emsg = "hippodclient relay not reachable at {}: {}".format(path, e)
+            raise ConfigurationException(emsg)
+        self.lock = asyncio.Lock()
+        self.batch = list()
+        self.flusher = None
+
+    async def _flush(self):
+        import asyncio
+        from hippodclient.relay import read_frame, write_frame
+        async with self.lock:
+            batch, self.batch = self.batch, list()
+            self.flusher = None
+            if not batch:
+                return
+            try:
+                write_frame(self.writer, [data.decode() for data, _ in batch])
+                await self.writer.drain()
+                status = await read_frame(self.reader)
+                if status is None or len(status) != len(batch):
+                    raise TransportException("relay closed the connection")
+            except asyncio.CancelledError:
+                for _, future in batch:
+                    future.cancel()
+                raise
+            except Exception as e:
+                # truncated, corrupt or missing reply: no post may wait forever
+                emsg = "relay failed: {}".format(str(e) or type(e).__name__)
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(TransportException(emsg))
+                return
+            for (_, future), code in zip(batch, status):
+                future.set_result(code)
+
+    async def _flush_later(self):
+        import asyncio
+        await asyncio.sleep(self.delay)
+        await self._flush()
+
+    async def post(self, url, data, headers):
+        import asyncio
+        future = asyncio.get_event_loop().create_future()
+        self.batch.append((data, future))
+        if len(self.batch) >= self.batch_size:
+            asyncio.ensure_future(self._flush())
+        elif self.flusher is None:
+            self.flusher = asyncio.ensure_future(self._flush_later())
+        return await future
+
+    async def close(self):
+        await self._flush()
+        self.writer.close()
+        self.reader = self.writer = None
+
+
+TRANSPORTS = dict()
+for cls in (AiohttpTransport, Http2Transport, H2cTransport, MemoryTransport, RelayTransport):
+    TRANSPORTS[cls.name] = cls
+
+
+def create_transport(transport):
+    """ Return a transport instance for a transport name or instance """
+    if isinstance(transport, Transport):
+        return transport
+    if transport not in TRANSPORTS:
+        emsg = "transport must be one of {}, not {}".format(", ".join(sorted(TRANSPORTS)), transport)
+        raise ConfigurationException(emsg)
+    return TRANSPORTS[transport]()
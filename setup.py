@@ -8,6 +8,8 @@ setup(name='hippodclient',
       author_email='hagen@jauu.net',
       license='MIT',
       packages=['hippodclient'],
+      extras_require={'http2': ['httpx[http2]']},
+      entry_points={'pytest11': ['hippodclient = hippodclient.pytest_plugin']},
       test_suite='nose.collector',
       tests_require=['nose'],
       classifiers=[